@@ -0,0 +1,614 @@
+"""Benchmark the data-access layers of hw1, hw2 and hw3 on synthetic data.
+
+hw1 and hw2 run against SQLite files, hw3 against mongomock (or a mongod given
+with --mongo-uri). Every benchmark reports latency percentiles, throughput,
+database round trips and peak traced memory, and the whole run is written as
+JSON so that two runs can be compared with --baseline.
+
+    python benchmarks/bench.py --scale 2 --output after.json --baseline before.json
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('hw1', 'hw2', 'hw3'):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+# rows of each dataset at --scale 1
+BASE_SIZES = {'films': 1000, 'users': 200, 'histories': 5000, 'games': 1000}
+
+GENRES = ['Action', 'Adventure', 'Platformer', 'Puzzle', 'Racing', 'Role-Playing', 'Sports', 'Strategy']
+PLATFORMS = ['Switch', 'Wii', 'WiiU', '3DS', 'DS', 'GameCube', 'N64']
+WORDS = ['Super', 'Mario', 'Legend', 'Kart', 'Party', 'Star', 'Quest', 'Island', 'Night', 'Return',
+         'Kingdom', 'Shadow', 'Dream', 'World', 'Ultra', 'Tales', 'Rising', 'Deluxe', 'Origins', 'Edge']
+
+
+class RoundTrips:
+    def __init__(self) -> None:
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int = 1) -> None:
+        with self._lock:
+            self.count += n
+
+
+class Benchmark:
+    def __init__(self, layer: str, round_trips: RoundTrips, trace_memory: bool = True) -> None:
+        self.layer = layer
+        self.round_trips = round_trips
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, name: str, func, calls: int = 1, items: int = None) -> list:
+        # func is called with the call number, its return values are handed back
+        latencies = []
+        returned = []
+        errors = []
+        output = io.StringIO()
+        round_trips = self.round_trips.count
+        if self.trace_memory:
+            tracemalloc.start()
+        with redirect_stdout(output):
+            for i in range(calls):
+                start = time.perf_counter()
+                try:
+                    returned.append(func(i))
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+                latencies.append(time.perf_counter() - start)
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        round_trips = self.round_trips.count - round_trips
+        # hw1 prints its failures instead of raising them
+        errors += [line for line in output.getvalue().splitlines()
+                   if line.startswith(('Error', 'An error occurred'))]
+
+        total = sum(latencies)
+        items = calls if items is None else items
+        percentiles = np.percentile(np.array(latencies) * 1000, [50, 95, 99]) if latencies else [0.0] * 3
+        self.results.append({
+            'layer': self.layer,
+            'name': name,
+            'calls': calls,
+            'items': items,
+            'seconds': round(total, 6),
+            'latency_ms': {
+                'p50': round(float(percentiles[0]), 4),
+                'p95': round(float(percentiles[1]), 4),
+                'p99': round(float(percentiles[2]), 4),
+                'max': round(max(latencies) * 1000, 4) if latencies else 0.0,
+                'mean': round(total / calls * 1000, 4) if calls else 0.0,
+            },
+            'throughput': {
+                'calls_per_sec': round(calls / total, 2) if total > 0 else None,
+                'items_per_sec': round(items / total, 2) if total > 0 else None,
+            },
+            'round_trips': {
+                'total': round_trips,
+                'per_call': round(round_trips / calls, 3) if calls else 0.0,
+            },
+            'peak_memory_kb': round(peak / 1024, 1) if peak is not None else None,
+            'errors': list(dict.fromkeys(errors))[:5],
+        })
+        return returned
+
+
+# synthetic datasets
+
+def make_films(count: int, rng: random.Random, start: int = 0) -> list:
+    films = []
+    for i in range(start, start + count):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) + f' {i}'
+        films.append((title, rng.randint(1920, 2023)))
+    # pin the year range so that films generated later never move the maximal distance
+    if start == 0 and films:
+        films[0] = (films[0][0], 1920)
+        films[-1] = (films[-1][0], 2023)
+    return films
+
+
+def make_users(count: int, rng: random.Random) -> list:
+    return [
+        (f'user{i}', f'password{i}', rng.choice(WORDS), rng.choice(WORDS),
+         datetime(1960, 1, 1) + timedelta(days=rng.randint(0, 365 * 45)))
+        for i in range(count)
+    ]
+
+
+def make_histories(count: int, users: list, film_count: int, rng: random.Random) -> list:
+    return [(rng.choice(users)[0], rng.randint(1, film_count)) for _ in range(count)]
+
+
+def make_games(count: int, rng: random.Random) -> list:
+    games = []
+    for i in range(count):
+        score = '' if rng.random() < 0.1 else round(rng.uniform(1, 10), 1)
+        games.append({
+            'meta_score': rng.randint(40, 99),
+            'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) + f' {i}',
+            'platform': rng.choice(PLATFORMS),
+            'date': f'Jan {rng.randint(1, 28)}, {rng.randint(1990, 2023)}',
+            'user_score': score,
+            'link': f'/game/{i}',
+            'esrb_rating': rng.choice(['E', 'E10+', 'T', '']),
+            'developers': "['Nintendo']",
+            'genres': str(rng.sample(GENRES, rng.randint(1, 3))),
+        })
+    return games
+
+
+def write_csv(path: str, rows: list, header: list = None) -> str:
+    with open(path, 'w', newline='') as file:
+        if header is None:
+            csv.writer(file).writerows(rows)
+        else:
+            writer = csv.DictWriter(file, fieldnames=header)
+            writer.writeheader()
+            writer.writerows(rows)
+    return path
+
+
+# hw1 - SQL Server stand-in on SQLite
+
+HW1_SCHEMA = [
+    "CREATE TABLE dbo.MediaItems (MID INTEGER PRIMARY KEY, TITLE VARCHAR(200), PROD_YEAR INTEGER, TITLE_LENGTH INTEGER)",
+    "CREATE TABLE dbo.Similarity (MID1 INTEGER, MID2 INTEGER, SIMILARITY REAL, PRIMARY KEY (MID1, MID2))",
+    "CREATE INDEX dbo.IX_Similarity_MID2 ON Similarity (MID2, SIMILARITY)",
+    "CREATE TABLE dbo.SimilarityItems (MID INTEGER PRIMARY KEY)",
+    # dbo.MediaItemsMID sequence
+    "CREATE TABLE dbo.MediaItemsMID (NEXT_VALUE INTEGER NOT NULL)",
+    "INSERT INTO dbo.MediaItemsMID VALUES (1)",
+]
+
+
+class SQLiteCursor:
+    # pyodbc style cursor: parameters are passed positionally and every execute is a round trip
+    def __init__(self, cursor, round_trips: RoundTrips) -> None:
+        self._cursor = cursor
+        self._round_trips = round_trips
+
+    def execute(self, sql: str, *params):
+        if len(params) == 1 and isinstance(params[0], (tuple, list)):
+            params = params[0]
+        self._round_trips.add()
+        self._cursor.execute(sql, params)
+        return self
+
+    def executemany(self, sql: str, rows) -> None:
+        self._round_trips.add()
+        self._cursor.executemany(sql, rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self) -> list:
+        return self._cursor.fetchall()
+
+    def close(self) -> None:
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, path: str, round_trips: RoundTrips) -> None:
+        # the tables live in an attached database named dbo, so dbo.<table> resolves like on SQL Server
+        self._connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self._connection.execute('ATTACH DATABASE ? AS dbo', (path,))
+        self._round_trips = round_trips
+
+    def cursor(self) -> SQLiteCursor:
+        return SQLiteCursor(self._connection.cursor(), self._round_trips)
+
+    def commit(self) -> None:
+        self._round_trips.add()
+        self._connection.commit()
+
+    def rollback(self) -> None:
+        self._connection.rollback()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def sqlite_mid_allocator(hw1, block_size: int):
+    class SQLiteMidAllocator(hw1.MidAllocator):
+        # sp_sequence_get_range on a one-row table
+        def _reserve(self, cursor, size: int) -> int:
+            cursor.execute("UPDATE dbo.MediaItemsMID SET NEXT_VALUE = NEXT_VALUE + ?", (size,))
+            return cursor.execute("SELECT NEXT_VALUE - ? FROM dbo.MediaItemsMID", (size,)).fetchone()[0]
+
+    return SQLiteMidAllocator(block_size)
+
+
+def hw1_manager(hw1, directory: str, name: str, round_trips: RoundTrips):
+    path = os.path.join(directory, f'{name}.sqlite')
+    connection = SQLiteConnection(path, round_trips)
+    for statement in HW1_SCHEMA:
+        connection._connection.execute(statement)
+    connection._connection.commit()
+    connection.close()
+    manager = hw1.DatabaseManager('', '', '', '', connection_factory=lambda: SQLiteConnection(path, round_trips))
+    manager.mid_allocator = sqlite_mid_allocator(hw1, 1000)
+    return manager
+
+
+def bench_hw1(data: dict, directory: str, repeat: int, trace_memory: bool) -> Benchmark:
+    import hw1
+
+    round_trips = RoundTrips()
+    bench = Benchmark('hw1', round_trips, trace_memory)
+    films, extra_films = data['films'], data['extra_films']
+    films_csv = write_csv(os.path.join(directory, 'films.csv'), films)
+    extra_csv = write_csv(os.path.join(directory, 'extra_films.csv'), extra_films)
+    few_csv = write_csv(os.path.join(directory, 'few_films.csv'), films[:min(len(films), 200)])
+
+    # the row at a time loader gets its own database, its MIDs come from the table instead of the sequence
+    row_manager = hw1_manager(hw1, directory, 'hw1_rows', round_trips)
+    bench.run('file_to_database', lambda i: row_manager.file_to_database(few_csv), items=min(len(films), 200))
+    row_manager.pool.close()
+
+    manager = hw1_manager(hw1, directory, 'hw1', round_trips)
+    bench.run('bulk_file_to_database', lambda i: manager.bulk_file_to_database(films_csv), items=len(films))
+
+    mids = list(range(1, len(films) + 1))
+    years = [year for _, year in films]
+    pairs = len(films) * (len(films) - 1) // 2
+
+    def consume(blocks) -> int:
+        return sum(len(mid1) for mid1, _, _ in blocks)
+
+    bench.run('full_similarity_blocks', lambda i: consume(hw1.full_similarity_blocks(mids, years)),
+              calls=repeat, items=pairs * repeat)
+    bench.run('full_similarity_blocks[threshold=0.9]',
+              lambda i: consume(hw1.full_similarity_blocks(mids, years, threshold=0.9)),
+              calls=repeat, items=pairs * repeat)
+
+    bench.run('calculate_similarity_vectorized', lambda i: manager.calculate_similarity_vectorized(), items=pairs)
+    bench.run('calculate_similarity_vectorized[threshold=0.9]',
+              lambda i: manager.calculate_similarity_vectorized(threshold=0.9), items=pairs)
+    bench.run('calculate_similarity_parallel[threshold=0.9]',
+              lambda i: manager.calculate_similarity_parallel(workers=2, tile_size=512, threshold=0.9), items=pairs)
+
+    # new films inside the existing year range take the incremental path
+    bench.run('bulk_file_to_database[extra]', lambda i: manager.bulk_file_to_database(extra_csv),
+              items=len(extra_films))
+    bench.run('update_similarity[threshold=0.9]', lambda i: manager.update_similarity(threshold=0.9),
+              items=len(extra_films) * (len(films) + len(extra_films)))
+
+    rng = random.Random(1)
+    sample = [rng.randint(1, len(films)) for _ in range(max(repeat * 10, 10))]
+    manager.similar_items_cache.clear()
+    bench.run('get_similar_items[cold]', lambda i: manager.get_similar_items(sample[i]), calls=len(sample))
+    bench.run('get_similar_items[cached]', lambda i: manager.get_similar_items(sample[i]), calls=len(sample))
+    manager.similar_items_cache.clear()
+    bench.run('get_similar_items_batch', lambda i: manager.get_similar_items_batch(sample), items=len(sample))
+    manager.pool.close()
+    return bench
+
+
+# hw2 - SQLAlchemy on SQLite
+
+def bench_hw2(data: dict, directory: str, repeat: int, trace_memory: bool, bcrypt_rounds: int) -> Benchmark:
+    import hw2
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+
+    hw2.BCRYPT_ROUNDS = bcrypt_rounds
+    round_trips = RoundTrips()
+    bench = Benchmark('hw2', round_trips, trace_memory)
+
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'hw2.sqlite')}")
+    event.listen(engine, 'connect', lambda connection, record: connection.execute('PRAGMA foreign_keys=ON'))
+    event.listen(engine, 'before_cursor_execute', lambda *args: round_trips.add())
+    hw2.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    item_service = hw2.ItemService(session, hw2.ItemRepository())
+    user_repo = hw2.UserRepository()
+    user_service = hw2.UserService(session, user_repo)
+    films, users, histories = data['films'], data['users'], data['histories']
+
+    bench.run('create_items', lambda i: item_service.create_items(films), items=len(films))
+    bench.run('create_users', lambda i: user_service.create_users(users), items=len(users))
+    extra = [(f'single{i}', 'password', 'First', 'Last', datetime(1990, 1, 1)) for i in range(repeat)]
+    bench.run('create_user', lambda i: user_service.create_user(*extra[i]), calls=len(extra))
+
+    bench.run('add_history_to_user', lambda i: user_service.add_history_to_user(*histories[i]),
+              calls=len(histories))
+
+    rng = random.Random(2)
+    sample = [rng.choice(users) for _ in range(max(repeat * 5, 5))]
+    # the field cache is already warm from add_history_to_user, cold here means no cached validation
+    bench.run('validateUser[cold]', lambda i: user_service.validateUser(sample[i][0], sample[i][1]),
+              calls=len(sample))
+    bench.run('validateUser[cached]', lambda i: user_service.validateUser(sample[i][0], sample[i][1]),
+              calls=len(sample))
+    bench.run('getNumberOfRegistredUsers', lambda i: user_service.getNumberOfRegistredUsers(30), calls=repeat)
+    bench.run('sum_title_length_to_user', lambda i: user_service.sum_title_length_to_user(sample[i][0]),
+              calls=len(sample))
+    usernames = [user[0] for user in users]
+    bench.run('sum_title_length_for_users', lambda i: user_service.sum_title_length_for_users(usernames),
+              calls=repeat, items=len(usernames) * repeat)
+    bench.run('iter_users', lambda i: sum(1 for _ in user_service.iter_users(batch_size=100)),
+              calls=repeat, items=len(users) * repeat)
+    bench.run('get_all_users', lambda i: len(user_service.get_all_users()), calls=repeat, items=len(users) * repeat)
+
+    item_repo = item_service.item_repo
+    bench.run('getTopNItems', lambda i: item_repo.getTopNItems(session, 100), calls=repeat)
+    ids = list(range(1, len(films) + 1))
+    session.expunge_all()
+    # the identity map is weak, keep the loaded items referenced for the second run
+    loaded = bench.run('get_many[cold]', lambda i: item_repo.get_many(session, ids), items=len(ids))
+    bench.run('get_many[identity map]', lambda i: item_repo.get_many(session, ids), items=len(ids))
+    del loaded
+    session.close()
+    engine.dispose()
+    return bench
+
+
+# hw3 - pymongo on mongomock or a mongod
+
+# collection methods that are one round trip each on a real server
+MONGO_OPERATIONS = ['find', 'find_one', 'find_one_and_update', 'insert_one', 'insert_many', 'update_one',
+                    'update_many', 'delete_many', 'aggregate', 'distinct', 'create_index', 'bulk_write',
+                    'count_documents', 'estimated_document_count']
+
+
+@contextmanager
+def mongomock_round_trips(round_trips: RoundTrips):
+    # mongomock has no command monitoring, so count the outermost collection calls
+    import mongomock
+
+    depth = threading.local()
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            outermost = not getattr(depth, 'value', 0)
+            if outermost:
+                round_trips.add()
+            depth.value = getattr(depth, 'value', 0) + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                depth.value -= 1
+        return wrapper
+
+    patches = [mock.patch.object(mongomock.collection.Collection, name,
+                                 counted(getattr(mongomock.collection.Collection, name)))
+               for name in MONGO_OPERATIONS if hasattr(mongomock.collection.Collection, name)]
+    for patch in patches:
+        patch.start()
+    try:
+        yield
+    finally:
+        for patch in patches:
+            patch.stop()
+
+
+@contextmanager
+def mongo_client(round_trips: RoundTrips, uri: str = None):
+    # hw3 connects to a hard-coded localhost URI, hand it our client instead
+    if uri is None:
+        import mongomock
+        client = mongomock.MongoClient()
+        with mongomock_round_trips(round_trips), mock.patch('pymongo.MongoClient', lambda *args, **kwargs: client):
+            yield client
+        return
+
+    import pymongo
+    from pymongo import monitoring
+
+    class CommandCounter(monitoring.CommandListener):
+        def started(self, event):
+            round_trips.add()
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    client = pymongo.MongoClient(uri, event_listeners=[CommandCounter()])
+    try:
+        with mock.patch('pymongo.MongoClient', lambda *args, **kwargs: client):
+            yield client
+    finally:
+        client.close()
+
+
+def bench_hw3(data: dict, directory: str, repeat: int, trace_memory: bool, bcrypt_rounds: int,
+              mongo_uri: str = None) -> Benchmark:
+    import hw3
+
+    round_trips = RoundTrips()
+    bench = Benchmark('hw3', round_trips, trace_memory)
+    games, users = data['games'], data['users']
+    games_csv = write_csv(os.path.join(directory, 'games.csv'), games, list(games[0]))
+
+    with mongo_client(round_trips, mongo_uri) as client:
+        client.drop_database('hw3')
+        db_manager = hw3.DBManager()
+        login_manager = hw3.LoginManager(rounds=bcrypt_rounds)
+
+        bench.run('load_csv', lambda i: db_manager.load_csv(games_csv), items=len(games))
+        bench.run('rebuild_platform_stats', lambda i: db_manager.rebuild_platform_stats(), calls=repeat)
+        bench.run('rebuild_title_index', lambda i: db_manager.rebuild_title_index(), calls=repeat)
+
+        accounts = users[:max(repeat * 5, 5)]
+        bench.run('register_user', lambda i: login_manager.register_user(*accounts[i][:2]), calls=len(accounts))
+        tokens = bench.run('login_user', lambda i: login_manager.login_user(*accounts[i][:2]), calls=len(accounts))
+        bench.run('validate_session', lambda i: login_manager.validate_session(tokens[i % len(tokens)]),
+                  calls=len(tokens) * 10)
+
+        def fetch_user(i: int) -> dict:
+            return db_manager.user_collection.find_one({'username': accounts[i % len(accounts)][0]})
+
+        rng = random.Random(3)
+        titles = [game['title'] for game in games]
+        singles = rng.sample(titles, min(len(titles), repeat * 10))
+        user = fetch_user(0)
+        bench.run('rent_game', lambda i: db_manager.rent_game(user, singles[i]), calls=len(singles))
+        user = fetch_user(0)
+        bench.run('return_game', lambda i: db_manager.return_game(user, singles[i]), calls=len(singles))
+
+        batch = rng.sample(titles, min(len(titles), 50))
+        user = fetch_user(1)
+        bench.run('rent_games', lambda i: db_manager.rent_games(user, batch), items=len(batch))
+        user = fetch_user(1)
+        bench.run('recommend_games_by_genre', lambda i: db_manager.recommend_games_by_genre(user), calls=repeat * 5)
+        bench.run('recommend_games_by_name', lambda i: db_manager.recommend_games_by_name(user), calls=repeat * 5)
+        bench.run('return_games', lambda i: db_manager.return_games(user, batch), items=len(batch))
+
+        bench.run('find_top_rated_games', lambda i: db_manager.find_top_rated_games(8), calls=repeat)
+        bench.run('get_average_score_per_platform', lambda i: db_manager.get_average_score_per_platform(),
+                  calls=repeat)
+        bench.run('decrement_scores', lambda i: db_manager.decrement_scores(PLATFORMS[i % len(PLATFORMS)]),
+                  calls=repeat)
+        bench.run('get_genres_distribution', lambda i: db_manager.get_genres_distribution(), calls=repeat)
+        client.drop_database('hw3')
+    return bench
+
+
+# reporting
+
+def compare(results: list, baseline: dict) -> list:
+    # p50 and round trips of this run relative to the baseline run
+    previous = {(result['layer'], result['name']): result for result in baseline.get('results', [])}
+    comparison = []
+    for result in results:
+        before = previous.get((result['layer'], result['name']))
+        if before is None:
+            continue
+        p50, before_p50 = result['latency_ms']['p50'], before['latency_ms']['p50']
+        comparison.append({
+            'layer': result['layer'],
+            'name': result['name'],
+            'p50_ratio': round(p50 / before_p50, 3) if before_p50 else None,
+            'round_trips_before': before['round_trips']['total'],
+            'round_trips_after': result['round_trips']['total'],
+        })
+    return comparison
+
+
+def print_table(results: list, comparison: list, stream) -> None:
+    ratios = {(row['layer'], row['name']): row['p50_ratio'] for row in comparison}
+    print(f"{'benchmark':<52}{'calls':>7}{'p50 ms':>11}{'p95 ms':>11}{'items/s':>12}{'trips':>8}{'peak KB':>10}"
+          + ('  vs baseline' if comparison else ''), file=stream)
+    for result in results:
+        ratio = ratios.get((result['layer'], result['name']))
+        items_per_sec = result['throughput']['items_per_sec']
+        peak = result['peak_memory_kb']
+        print(f"{result['layer'] + '.' + result['name']:<52}{result['calls']:>7}"
+              f"{result['latency_ms']['p50']:>11.3f}{result['latency_ms']['p95']:>11.3f}"
+              f"{items_per_sec if items_per_sec is not None else 0:>12.0f}{result['round_trips']['total']:>8}"
+              f"{peak if peak is not None else 0:>10.0f}"
+              + (f"  x{ratio:.2f}" if ratio else '')
+              + (f"  ERROR {result['errors'][0]}" if result['errors'] else ''), file=stream)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the hw1, hw2 and hw3 data-access layers.')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for every dataset size')
+    for name, size in BASE_SIZES.items():
+        parser.add_argument(f'--{name}', type=int, help=f'number of {name} (default {size} x scale)')
+    parser.add_argument('--repeat', type=int, default=5, help='calls of each repeatable benchmark')
+    parser.add_argument('--layers', default='hw1,hw2,hw3', help='comma separated layers to run')
+    parser.add_argument('--bcrypt-rounds', type=int, default=4, help='bcrypt work factor for created users')
+    parser.add_argument('--mongo-uri', help='run hw3 on this mongod instead of mongomock, its hw3 database is dropped')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory, tracing slows Python code down')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    sizes = {name: getattr(args, name) or max(int(size * args.scale), 10) for name, size in BASE_SIZES.items()}
+    rng = random.Random(args.seed)
+    users = make_users(sizes['users'], rng)
+    data = {
+        'films': make_films(sizes['films'], rng),
+        'extra_films': make_films(max(sizes['films'] // 20, 1), rng, start=sizes['films']),
+        'users': users,
+        'histories': make_histories(sizes['histories'], users, sizes['films'], rng),
+        'games': make_games(sizes['games'], rng),
+    }
+
+    layers = [layer.strip() for layer in args.layers.split(',') if layer.strip()]
+    trace_memory = not args.no_memory
+    results = []
+    skipped = {}
+    directory = tempfile.mkdtemp(prefix='dbm-bench-')
+    try:
+        for layer in layers:
+            try:
+                if layer == 'hw1':
+                    bench = bench_hw1(data, directory, args.repeat, trace_memory)
+                elif layer == 'hw2':
+                    bench = bench_hw2(data, directory, args.repeat, trace_memory, args.bcrypt_rounds)
+                elif layer == 'hw3':
+                    bench = bench_hw3(data, directory, args.repeat, trace_memory, args.bcrypt_rounds, args.mongo_uri)
+                else:
+                    parser.error(f'unknown layer {layer}')
+            except ImportError as e:
+                # e.g. pyodbc without an ODBC driver manager, or mongomock not installed
+                skipped[layer] = f"{type(e).__name__}: {e}"
+                print(f"skipping {layer}: {e}", file=sys.stderr)
+                continue
+            results.extend(bench.results)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    comparison = compare(results, baseline) if baseline else []
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': sizes,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'bcrypt_rounds': args.bcrypt_rounds,
+            'memory_traced': trace_memory,
+            'backends': {'hw1': 'sqlite', 'hw2': 'sqlite', 'hw3': 'mongod' if args.mongo_uri else 'mongomock'},
+            'skipped': skipped,
+        },
+        'results': results,
+    }
+    if comparison:
+        report['comparison'] = comparison
+
+    print_table(results, comparison, sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
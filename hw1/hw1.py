@@ -1,154 +1,730 @@
 import csv
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
 import pyodbc
 
+
+def read_csv_chunks(path: str, chunk_size: int):
+    # stream valid (title, prod_year) rows from the csv in lists of chunk_size
+    chunk = []
+    with open(path, "r") as file:
+        for row in csv.reader(file):
+            # validate both entries
+            if len(row) < 2:
+                continue
+            title = row[0]
+            prod_year = row[1]
+
+            # check that the values are in correct format
+            if not title or not prod_year.isdigit():
+                continue
+
+            chunk.append((title, int(prod_year)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def similarity_values(distance, maximal_distance):
+    # same formula as dbo.SimCalculation
+    if maximal_distance == 0:
+        return np.ones(len(distance))
+    return 1 - np.abs(distance) / float(maximal_distance)
+
+
+def _row_blocks(counts, block_pairs: int):
+    # split rows into consecutive (start, stop) ranges of at most block_pairs pairs, a longer row goes alone
+    cumulative = np.cumsum(counts)
+    n = len(cumulative)
+    start = 0
+    while start < n:
+        done = cumulative[start - 1] if start else 0
+        stop = max(int(np.searchsorted(cumulative, done + block_pairs, side="right")), start + 1)
+        yield start, min(stop, n)
+        start = stop
+
+
+def similarity_blocks(mids, years, maximal_distance, block_pairs: int = 1000000):
+    # compute rows of the upper triangle, about block_pairs pairs at a time
+    mids = np.asarray(mids, dtype=np.int64)
+    years = np.asarray(years, dtype=np.float64)
+    n = len(mids)
+    row_counts = np.arange(n - 1, -1, -1)
+    for start, stop in _row_blocks(row_counts, block_pairs):
+        # row i pairs with every column after it, built without a rows x n mask
+        counts = row_counts[start:stop]
+        rows = np.repeat(np.arange(start, stop), counts)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols = rows + 1 + offsets
+        yield mids[rows], mids[cols], similarity_values(years[rows] - years[cols], maximal_distance)
+
+
+def delta_similarity_blocks(new_mids, new_years, old_mids, old_years, maximal_distance, block_pairs: int = 1000000):
+    # pairs of new items against the existing ones, then among themselves
+    new_mids = np.asarray(new_mids, dtype=np.int64)
+    new_years = np.asarray(new_years, dtype=np.float64)
+    old_mids = np.asarray(old_mids, dtype=np.int64)
+    old_years = np.asarray(old_years, dtype=np.float64)
+    if len(old_mids):
+        for start, stop in _row_blocks(np.full(len(new_mids), len(old_mids)), block_pairs):
+            block_mids = new_mids[start:stop, None]
+            block_years = new_years[start:stop, None]
+            # keep MID1 < MID2 like the full computation
+            mid1 = np.minimum(block_mids, old_mids[None, :]).ravel()
+            mid2 = np.maximum(block_mids, old_mids[None, :]).ravel()
+            yield mid1, mid2, similarity_values((block_years - old_years[None, :]).ravel(), maximal_distance)
+    yield from similarity_blocks(new_mids, new_years, maximal_distance, block_pairs)
+
+
+def sparse_similarity_blocks(mids, years, maximal_distance, threshold: float, block_pairs: int = 1000000):
+    # only pairs with similarity >= threshold, i.e. a year gap of at most (1 - threshold) * maximal_distance
+    mids = np.asarray(mids, dtype=np.int64)
+    years = np.asarray(years, dtype=np.float64)
+    order = np.argsort(years, kind="stable")
+    mids = mids[order]
+    years = years[order]
+    max_gap = (1 - threshold) * maximal_distance
+    # index one past the last item inside each item's year window
+    window_end = np.searchsorted(years, years + max_gap + 1e-9, side="right")
+    n = len(mids)
+    window_counts = window_end - np.arange(1, n + 1)
+    for start, stop in _row_blocks(window_counts, block_pairs):
+        counts = window_counts[start:stop]
+        rows = np.repeat(np.arange(start, stop), counts)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols = rows + 1 + offsets
+        similarity = similarity_values(years[rows] - years[cols], maximal_distance)
+        keep = similarity >= threshold
+        rows, cols, similarity = rows[keep], cols[keep], similarity[keep]
+        # keep MID1 < MID2 like the full computation
+        mid1 = np.minimum(mids[rows], mids[cols])
+        mid2 = np.maximum(mids[rows], mids[cols])
+        yield mid1, mid2, similarity
+
+
+def threshold_blocks(blocks, threshold: float):
+    for mid1, mid2, similarity in blocks:
+        keep = similarity >= threshold
+        yield mid1[keep], mid2[keep], similarity[keep]
+
+
+def full_similarity_blocks(mids, years, block_pairs: int = 1000000, threshold: float = None):
+    # same value as dbo.MaximalDistance()
+    maximal_distance = max(years) - min(years)
+    if threshold is None:
+        return similarity_blocks(mids, years, maximal_distance, block_pairs)
+    return sparse_similarity_blocks(mids, years, maximal_distance, threshold, block_pairs)
+
+
+_tile_mids = None
+_tile_years = None
+
+
+def _attach_tile_arrays(mids_path: str, years_path: str) -> None:
+    # each worker maps the same files instead of receiving its own copy
+    global _tile_mids, _tile_years
+    _tile_mids = np.load(mids_path, mmap_mode="r")
+    _tile_years = np.load(years_path, mmap_mode="r")
+
+
+def _similarity_tile(tile):
+    row_start, row_stop, col_start, col_stop, maximal_distance, threshold = tile
+    rows, cols = np.nonzero(
+        np.arange(col_start, col_stop)[None, :] > np.arange(row_start, row_stop)[:, None]
+    )
+    rows += row_start
+    cols += col_start
+    similarity = similarity_values(_tile_years[rows] - _tile_years[cols], maximal_distance)
+    mid1 = _tile_mids[rows]
+    mid2 = _tile_mids[cols]
+    if threshold is not None:
+        keep = similarity >= threshold
+        mid1, mid2, similarity = mid1[keep], mid2[keep], similarity[keep]
+    return mid1, mid2, similarity
+
+
+def parallel_similarity_blocks(mids, years, workers: int = None, tile_size: int = 2048, threshold: float = None):
+    # split the upper triangle into tile_size x tile_size tiles and compute them in worker processes
+    maximal_distance = max(years) - min(years)
+    n = len(mids)
+    tiles = [
+        (row_start, min(row_start + tile_size, n), col_start, min(col_start + tile_size, n),
+         maximal_distance, threshold)
+        for row_start in range(0, n, tile_size)
+        for col_start in range(row_start, n, tile_size)
+    ]
+    directory = tempfile.mkdtemp(prefix="similarity_")
+    try:
+        mids_path = os.path.join(directory, "mids.npy")
+        years_path = os.path.join(directory, "years.npy")
+        np.save(mids_path, np.asarray(mids, dtype=np.int64))
+        np.save(years_path, np.asarray(years, dtype=np.float64))
+        workers = workers or os.cpu_count() or 1
+        with Pool(workers, initializer=_attach_tile_arrays, initargs=(mids_path, years_path)) as pool:
+            # at most 2 x workers tiles are queued or finished but unwritten, the next one is
+            # submitted only after the writer took one, so a slow writer holds the workers back
+            remaining = iter(tiles)
+            pending = deque(pool.apply_async(_similarity_tile, (tile,)) for tile in islice(remaining, 2 * workers))
+            while pending:
+                result = pending.popleft().get()
+                for tile in islice(remaining, 1):
+                    pending.append(pool.apply_async(_similarity_tile, (tile,)))
+                yield result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def write_similarity_blocks(cursor, blocks, batch_size: int = 10000) -> int:
+    # bulk load (MID1, MID2, SIMILARITY) blocks into dbo.Similarity
+    written = 0
+    for mid1, mid2, similarity in blocks:
+        # only one batch of python tuples exists at a time
+        for i in range(0, len(mid1), batch_size):
+            cursor.executemany(
+                "INSERT INTO dbo.Similarity (MID1, MID2, SIMILARITY) VALUES (?, ?, ?)",
+                list(zip(mid1[i:i + batch_size].tolist(), mid2[i:i + batch_size].tolist(),
+                         similarity[i:i + batch_size].tolist()))
+            )
+        written += len(mid1)
+    return written
+
+
+def fast_cursor(connection):
+    # batch executemany parameters when the driver supports it (pyodbc)
+    cursor = connection.cursor()
+    if hasattr(cursor, "fast_executemany"):
+        cursor.fast_executemany = True
+    return cursor
+
+
+class ConnectionPool:
+    def __init__(self, factory, max_size: int = 5, max_idle: float = 300.0,
+                 health_check_interval: float = 30.0, timeout: float = 30.0):
+        # factory is any callable returning a DB-API connection
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._idle = []  # (connection, last used time), most recently used last
+        self._size = 0
+        self._condition = threading.Condition()
+        self.stats = {"created": 0, "reused": 0, "closed": 0, "failed_checks": 0, "waits": 0}
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                self._close_expired()
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve a slot, the connection is opened outside the lock
+                    self._size += 1
+                    connection, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No connection available after {self.timeout}s")
+                self.stats["waits"] += 1
+                self._condition.wait(remaining)
+
+        if connection is not None:
+            # only ping connections that sat idle for a while
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(connection):
+                with self._condition:
+                    self.stats["reused"] += 1
+                return connection
+            with self._condition:
+                self.stats["failed_checks"] += 1
+            self._close(connection)
+
+        try:
+            connection = self.factory()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.stats["created"] += 1
+        return connection
+
+    def release(self, connection) -> None:
+        try:
+            # never hand uncommitted work to the next user
+            connection.rollback()
+        except Exception:
+            self._close(connection)
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _close_expired(self) -> None:
+        # called with the lock held, oldest connections are at the front
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            connection, _ = self._idle.pop(0)
+            self._size -= 1
+            self._close(connection)
+
+    def _is_healthy(self, connection) -> bool:
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, connection) -> None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self.stats["closed"] += 1
+
+
+class MidAllocator:
+    def __init__(self, block_size: int = 1000):
+        # hi/lo allocation: reserve blocks of dbo.MediaItemsMID and hand them out locally
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, cursor, count: int) -> list:
+        # MIDs of one call are always contiguous
+        with self._lock:
+            if self._end - self._next < count:
+                self._next = self._reserve(cursor, max(count, self.block_size))
+                self._end = self._next + max(count, self.block_size)
+            first = self._next
+            self._next += count
+        return list(range(first, first + count))
+
+    def _reserve(self, cursor, size: int) -> int:
+        # runs on the caller's connection, sequence ranges are not transactional so no commit is needed
+        cursor.execute("""
+                    SET NOCOUNT ON;
+                    DECLARE @first SQL_VARIANT;
+                    EXEC sys.sp_sequence_get_range
+                        @sequence_name = N'dbo.MediaItemsMID',
+                        @range_size = ?,
+                        @range_first_value = @first OUTPUT;
+                    SELECT CAST(@first AS BIGINT);
+                """, (size,))
+        return cursor.fetchone()[0]
+
+
+SimilarItem = namedtuple("SimilarItem", ["mid", "title", "similarity"])
+
+
+class TTLCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
 class DatabaseManager:
-    def __init__(self, driver: str, server: str, username: str, password: str):
+    def __init__(self, driver: str, server: str, username: str, password: str,
+                 connection_factory=None, pool_size: int = 5, max_idle: float = 300.0,
+                 mid_block_size: int = 1000):
         self.connection_string = f"DRIVER={driver};SERVER={server};UID={username};PWD={password};DATABASE={username};TrustServerCertificate=YES"
+        if connection_factory is None:
+            connection_factory = lambda: pyodbc.connect(self.connection_string)
+        self.pool = ConnectionPool(connection_factory, max_size=pool_size, max_idle=max_idle)
+        self.mid_allocator = MidAllocator(mid_block_size)
+        # (mid, threshold) -> similar items, cleared whenever this manager writes
+        self.similar_items_cache = TTLCache()
 
 
     def file_to_database(self, path: str) -> None:
         try:
-            connection = pyodbc.connect(self.connection_string)
-            print("Connection established successfully")
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                with open(path, "r") as file:
+                    csv_file = csv.reader(file)
 
-            cursor = connection.cursor()
-            with open(path, "r") as file:
-                csv_file = csv.reader(file)
-
-                for row in csv_file:
-                    # validate both entries
-                    if len(row) < 2:
-                        continue
-                    title = row[0]
-                    prod_year = row[1]
-
-                    # check that the values are in correct format
-                    if not title or not prod_year.isdigit():
-                        continue
-
-                    title_length = len(title)  # calculate the length of the title
-
-                    # check that there aren't any duplicates
-                    cursor.execute("SELECT COUNT(*) FROM dbo.MediaItems WHERE TITLE = ? AND PROD_YEAR = ?",
-                                   (title, prod_year))
-                    if cursor.fetchone()[0] > 0:
-                        continue
-
-                    cursor.execute(
-                        "INSERT INTO dbo.MediaItems (TITLE, PROD_YEAR, TITLE_LENGTH) VALUES (?, ?, ?)",
-                        (title, prod_year, title_length)
-                    )
-                    print("New entries were successfully inserted")
-                    connection.commit()
+                    for row in csv_file:
+                        # validate both entries
+                        if len(row) < 2:
+                            continue
+                        title = row[0]
+                        prod_year = row[1]
+
+                        # check that the values are in correct format
+                        if not title or not prod_year.isdigit():
+                            continue
+
+                        title_length = len(title)  # calculate the length of the title
+
+                        # check that there aren't any duplicates
+                        cursor.execute("SELECT COUNT(*) FROM dbo.MediaItems WHERE TITLE = ? AND PROD_YEAR = ?",
+                                       (title, prod_year))
+                        if cursor.fetchone()[0] > 0:
+                            continue
+
+                        cursor.execute(
+                            "INSERT INTO dbo.MediaItems (TITLE, PROD_YEAR, TITLE_LENGTH) VALUES (?, ?, ?)",
+                            (title, prod_year, title_length)
+                        )
+                        print("New entries were successfully inserted")
+                        connection.commit()
+                        self.similar_items_cache.clear()
         except Exception as e:
             print("Error", e)
-        finally:
-            if connection:
-                connection.close()
 
-    def calculate_similarity(self) -> None:
+    def bulk_file_to_database(self, path: str, batch_size: int = 1000, commit_interval: int = 10) -> None:
         try:
-            connection = pyodbc.connect(self.connection_string)
-            print("Connection established successfully")
+            with self.pool.connection() as connection:
+                cursor = fast_cursor(connection)
 
-            cursor = connection.cursor()
+                # preload all existing keys once instead of probing per row
+                cursor.execute("SELECT TITLE, PROD_YEAR FROM dbo.MediaItems")
+                existing = {(title, prod_year) for title, prod_year in cursor.fetchall()}
 
-            cursor.execute("SELECT MID FROM dbo.MediaItems")
-            all_MIDs = [row[0] for row in cursor.fetchall()]
+                start = time.perf_counter()
+                inserted = 0
+                for batch_number, chunk in enumerate(read_csv_chunks(path, batch_size), start=1):
+                    rows = []
+                    for title, prod_year in chunk:
+                        # check that there aren't any duplicates (in the DB or earlier in the file)
+                        if (title, prod_year) in existing:
+                            continue
+                        existing.add((title, prod_year))
+                        rows.append((title, prod_year, len(title)))
 
-            cursor.execute("SELECT dbo.MaximalDistance()")
-            maximal_distance = cursor.fetchone()[0]
+                    if rows:
+                        # MIDs come from a reserved range so parallel loaders never collide
+                        mids = self.mid_allocator.allocate(cursor, len(rows))
+                        cursor.executemany(
+                            "INSERT INTO dbo.MediaItems (MID, TITLE, PROD_YEAR, TITLE_LENGTH) VALUES (?, ?, ?, ?)",
+                            [(mid,) + row for mid, row in zip(mids, rows)]
+                        )
+                        inserted += len(rows)
 
-            # calculate the similarity
-            for i in range(len(all_MIDs)):
-                for j in range(i + 1, len(all_MIDs)):  # Ensure unique pairs (MID1, MID2)
-                    mid1 = all_MIDs[i]
-                    mid2 = all_MIDs[j]
+                    # commit every commit_interval batches
+                    if batch_number % commit_interval == 0:
+                        connection.commit()
+                        self.similar_items_cache.clear()
 
-                    # check that MIDs are different
-                    if mid1 == mid2:
-                        continue
+                connection.commit()
 
-                    # use SimCalculation function to get the similarity between the two MIDs
-                    cursor.execute("SELECT dbo.SimCalculation(?, ?, ?)", mid1, mid2, maximal_distance)
-                    similarity = cursor.fetchone()[0]
+                self.similar_items_cache.clear()
+                elapsed = time.perf_counter() - start
+                rate = inserted / elapsed if elapsed > 0 else 0.0
+                print(f"{inserted} new entries were successfully inserted in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+        except Exception as e:
+            print("Error", e)
 
-                    # check that it's not already in DB
-                    cursor.execute("SELECT * FROM dbo.Similarity WHERE MID1 = ? AND MID2 = ?",
-                                   (mid2, mid1))
-                    if cursor.fetchone() is not None:
-                        if cursor.fetchone()[0] > 0:
+    def calculate_similarity(self) -> None:
+        try:
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+
+                cursor.execute("SELECT MID FROM dbo.MediaItems")
+                all_MIDs = [row[0] for row in cursor.fetchall()]
+
+                cursor.execute("SELECT dbo.MaximalDistance()")
+                maximal_distance = cursor.fetchone()[0]
+
+                # calculate the similarity
+                for i in range(len(all_MIDs)):
+                    for j in range(i + 1, len(all_MIDs)):  # Ensure unique pairs (MID1, MID2)
+                        mid1 = all_MIDs[i]
+                        mid2 = all_MIDs[j]
+
+                        # check that MIDs are different
+                        if mid1 == mid2:
                             continue
 
-                    # insert to DB
+                        # use SimCalculation function to get the similarity between the two MIDs
+                        cursor.execute("SELECT dbo.SimCalculation(?, ?, ?)", mid1, mid2, maximal_distance)
+                        similarity = cursor.fetchone()[0]
+
+                        # check that it's not already in DB
+                        cursor.execute("SELECT * FROM dbo.Similarity WHERE MID1 = ? AND MID2 = ?",
+                                       (mid2, mid1))
+                        if cursor.fetchone() is not None:
+                            if cursor.fetchone()[0] > 0:
+                                continue
+
+                        # insert to DB
+                        cursor.execute("""
+                                    IF EXISTS (SELECT 1 FROM dbo.Similarity WHERE MID1 = ? AND MID2 = ?)
+                                    BEGIN
+                                        UPDATE dbo.Similarity
+                                        SET SIMILARITY = ?
+                                        WHERE MID1 = ? AND MID2 = ?
+                                    END
+                                    ELSE
+                                    BEGIN
+                                        INSERT INTO dbo.Similarity (MID1, MID2, SIMILARITY)
+                                        VALUES (?, ?, ?)
+                                    END
+                                """, mid1, mid2, similarity, mid1, mid2, mid1, mid2, similarity)
+                        print(f"Similarity was successfully inserted MID1:{mid1}, MID2:{mid2}")
+
+                # commit to database
+                connection.commit()
+                self.similar_items_cache.clear()
+                print(f"similarity between {mid1} and {mid2} was successfully inserted")
+        except Exception as e:
+            print("Error", e)
+
+    def calculate_similarity_vectorized(self, block_pairs: int = 1000000, batch_size: int = 10000,
+                                        threshold: float = None) -> None:
+        try:
+            with self.pool.connection() as connection:
+                cursor = fast_cursor(connection)
+
+                # fetch all items once, ordered like the pairwise loop
+                cursor.execute("SELECT MID, PROD_YEAR FROM dbo.MediaItems ORDER BY MID")
+                items = cursor.fetchall()
+                if not items:
+                    print("No media items found")
+                    return
+
+                mids = [row[0] for row in items]
+                years = [row[1] for row in items]
+
+                start = time.perf_counter()
+                written = self._rebuild_similarity(
+                    cursor, mids, full_similarity_blocks(mids, years, block_pairs, threshold), batch_size
+                )
+                connection.commit()
+                self.similar_items_cache.clear()
+                elapsed = time.perf_counter() - start
+                print(f"{written} similarities were successfully inserted in {elapsed:.2f}s")
+        except Exception as e:
+            print("Error", e)
+
+    def calculate_similarity_parallel(self, workers: int = None, tile_size: int = 2048, batch_size: int = 10000,
+                                      threshold: float = None) -> None:
+        try:
+            with self.pool.connection() as connection:
+                cursor = fast_cursor(connection)
+
+                cursor.execute("SELECT MID, PROD_YEAR FROM dbo.MediaItems ORDER BY MID")
+                items = cursor.fetchall()
+                if not items:
+                    print("No media items found")
+                    return
+                mids = [row[0] for row in items]
+                years = [row[1] for row in items]
+
+                start = time.perf_counter()
+                written = self._rebuild_similarity(
+                    cursor, mids, parallel_similarity_blocks(mids, years, workers, tile_size, threshold), batch_size
+                )
+                connection.commit()
+                self.similar_items_cache.clear()
+                elapsed = time.perf_counter() - start
+                print(f"{written} similarities were successfully inserted in {elapsed:.2f}s")
+        except Exception as e:
+            print("Error", e)
+
+    def update_similarity(self, block_pairs: int = 1000000, batch_size: int = 10000, threshold: float = None) -> None:
+        try:
+            with self.pool.connection() as connection:
+                cursor = fast_cursor(connection)
+
+                cursor.execute("SELECT MID, PROD_YEAR FROM dbo.MediaItems ORDER BY MID")
+                items = cursor.fetchall()
+                cursor.execute("SELECT MID FROM dbo.SimilarityItems")
+                processed = {row[0] for row in cursor.fetchall()}
+                mids = [row[0] for row in items]
+                years = [row[1] for row in items]
+
+                start = time.perf_counter()
+                # nothing computed yet - fall back to a full rebuild
+                if not processed:
+                    written = self._rebuild_similarity(
+                        cursor, mids, full_similarity_blocks(mids, years, block_pairs, threshold), batch_size
+                    )
+                    connection.commit()
+                    self.similar_items_cache.clear()
+                    print(f"{written} similarities were successfully inserted in {time.perf_counter() - start:.2f}s")
+                    return
+
+                old_items = [row for row in items if row[0] in processed]
+                new_items = [row for row in items if row[0] not in processed]
+                if not new_items:
+                    print("No new media items found")
+                    return
+
+                old_years = [row[1] for row in old_items]
+                old_distance = max(old_years) - min(old_years)
+                maximal_distance = max(years) - min(years)
+
+                # with a threshold a moved year range changes which pairs are stored, so rebuild
+                if threshold is not None and maximal_distance != old_distance:
+                    written = self._rebuild_similarity(
+                        cursor, mids, full_similarity_blocks(mids, years, block_pairs, threshold), batch_size
+                    )
+                    connection.commit()
+                    self.similar_items_cache.clear()
+                    print(f"Maximal distance changed, {written} similarities were rebuilt in {time.perf_counter() - start:.2f}s")
+                    return
+
+                # the year range moved - rescale the existing rows in one statement
+                if maximal_distance != old_distance:
                     cursor.execute("""
-                                IF EXISTS (SELECT 1 FROM dbo.Similarity WHERE MID1 = ? AND MID2 = ?)
-                                BEGIN
-                                    UPDATE dbo.Similarity
-                                    SET SIMILARITY = ?
-                                    WHERE MID1 = ? AND MID2 = ?
-                                END
-                                ELSE
-                                BEGIN
-                                    INSERT INTO dbo.Similarity (MID1, MID2, SIMILARITY)
-                                    VALUES (?, ?, ?)
-                                END
-                            """, mid1, mid2, similarity, mid1, mid2, mid1, mid2, similarity)
-                    print(f"Similarity was successfully inserted MID1:{mid1}, MID2:{mid2}")
-
-            # commit to database
-            connection.commit()
-            print(f"similarity between {mid1} and {mid2} was successfully inserted")
+                                UPDATE s
+                                SET SIMILARITY = 1 - ABS(m1.PROD_YEAR - m2.PROD_YEAR) / CAST(? AS FLOAT)
+                                FROM dbo.Similarity s
+                                INNER JOIN dbo.MediaItems m1 ON m1.MID = s.MID1
+                                INNER JOIN dbo.MediaItems m2 ON m2.MID = s.MID2
+                            """, (maximal_distance,))
+                    print(f"Maximal distance changed from {old_distance} to {maximal_distance}, rescaled existing similarities")
+
+                blocks = delta_similarity_blocks(
+                    [row[0] for row in new_items], [row[1] for row in new_items],
+                    [row[0] for row in old_items], old_years,
+                    maximal_distance, block_pairs
+                )
+                if threshold is not None:
+                    blocks = threshold_blocks(blocks, threshold)
+                written = write_similarity_blocks(cursor, blocks, batch_size)
+                cursor.executemany("INSERT INTO dbo.SimilarityItems (MID) VALUES (?)", [(row[0],) for row in new_items])
+                connection.commit()
+                self.similar_items_cache.clear()
+                print(f"{written} similarities for {len(new_items)} new items were inserted in {time.perf_counter() - start:.2f}s")
         except Exception as e:
             print("Error", e)
-        finally:
-            if connection:
-                connection.close()
+
+    def _rebuild_similarity(self, cursor, mids, blocks, batch_size: int) -> int:
+        # replace the table contents and remember which items were covered
+        cursor.execute("DELETE FROM dbo.Similarity")
+        cursor.execute("DELETE FROM dbo.SimilarityItems")
+        written = write_similarity_blocks(cursor, blocks, batch_size)
+        cursor.executemany("INSERT INTO dbo.SimilarityItems (MID) VALUES (?)", [(mid,) for mid in mids])
+        return written
+
+    def get_similar_items(self, mid: int, k: int = 10, threshold: float = 0.25) -> list:
+        return self.get_similar_items_batch([mid], k, threshold)[mid]
+
+    def get_similar_items_batch(self, mids, k: int = 10, threshold: float = 0.25) -> dict:
+        results = {}
+        missing = []
+        for mid in mids:
+            cached = self.similar_items_cache.get((mid, threshold))
+            if cached is None:
+                missing.append(mid)
+            else:
+                results[mid] = cached
+
+        # stay well below the 2100 parameter limit of SQL Server
+        for i in range(0, len(missing), 1000):
+            chunk = missing[i:i + 1000]
+            placeholders = ", ".join("?" * len(chunk))
+            fetched = {mid: [] for mid in chunk}
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                # one seek per side of the pair instead of an OR-join
+                cursor.execute(
+                    f"""SELECT x.MID, x.OTHER, m.TITLE, x.SIMILARITY
+                          FROM (
+                              SELECT MID1 AS MID, MID2 AS OTHER, SIMILARITY
+                              FROM dbo.Similarity
+                              WHERE MID1 IN ({placeholders}) AND SIMILARITY >= ?
+                              UNION ALL
+                              SELECT MID2, MID1, SIMILARITY
+                              FROM dbo.Similarity
+                              WHERE MID2 IN ({placeholders}) AND SIMILARITY >= ?
+                          ) x
+                          INNER JOIN dbo.MediaItems m ON m.MID = x.OTHER
+                          ORDER BY x.MID, x.SIMILARITY DESC;
+                      """, (*chunk, threshold, *chunk, threshold))
+                for mid, other, title, similarity in cursor.fetchall():
+                    fetched[mid].append(SimilarItem(other, title, similarity))
+            for mid, items in fetched.items():
+                self.similar_items_cache.put((mid, threshold), items)
+            results.update(fetched)
+
+        return {mid: results[mid] if k is None else results[mid][:k] for mid in mids}
 
     def print_similar_items(self, mid: int) -> None:
         try:
-            connection = pyodbc.connect(self.connection_string)
-            print("Connection established successfully")
-
-            cursor = connection.cursor()
             # retrieve items with similarity >= 0.25
-            cursor.execute(
-                """SELECT s.MID1, s.MID2, s.SIMILARITY, m.TITLE
-                      FROM dbo.Similarity s
-                      INNER JOIN dbo.MediaItems m
-                      ON (s.MID1 = m.MID AND s.MID2 = ?) OR (s.MID2 = m.MID AND s.MID1 = ?)
-                      WHERE s.SIMILARITY >= 0.25
-                      ORDER BY s.SIMILARITY ASC;
-                  """, mid, mid)
-
-            results = cursor.fetchall()
+            results = self.get_similar_items(mid, k=None, threshold=0.25)
             if not results:
                 print(f"No similar items found for MID {mid}")
                 return
 
-            for row in results:
-                mid1, mid2, similarity, title = row
-                print(f"{title} {similarity}")
+            for item in reversed(results):
+                print(f"{item.title} {item.similarity}")
 
         except Exception as e:
             print(f"An error occurred: {e}")
 
-        finally:
-            if connection:
-                connection.close()
-
-    def add_summary_items(self) -> None:
+    def add_summary_items(self, set_based: bool = True) -> None:
         try:
-            connection = pyodbc.connect(self.connection_string)
-            cursor = connection.cursor()
-            # use addSummaryItems
-            cursor.execute("EXEC AddSummaryItems")
-            connection.commit()
-            print("Summary items added successfully.")
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                # use addSummaryItems, or its set-based version
+                cursor.execute("EXEC AddSummaryItemsSetBased" if set_based else "EXEC AddSummaryItems")
+                connection.commit()
+                self.similar_items_cache.clear()
+                print("Summary items added successfully.")
 
         except Exception as e:
             print(f"An error occurred while executing AddSummaryItems: {e}")
-
-        finally:
-            if connection:
-                connection.close()
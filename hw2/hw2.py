@@ -1,13 +1,37 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, LargeBinary, text
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, LargeBinary, text, insert, Index
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from sqlalchemy import func, inspect, event
+from sqlalchemy.orm.util import identity_key
 import bcrypt
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import hashlib
+import hmac
+import secrets
+import time
+import weakref
 
 Base = declarative_base()
 
+# bcrypt work factor for new hashes, older hashes are upgraded on the next successful login
+BCRYPT_ROUNDS = 12
+
+
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def hash_password(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+
 class User(Base):
     __tablename__ = "Users"
     id = Column(String(255), primary_key=True)
@@ -15,7 +39,7 @@ class User(Base):
     first_name = Column(String(255))
     last_name = Column(String(255))
     date_of_birth = Column(DateTime)
-    registration_date = Column(DateTime)
+    registration_date = Column(DateTime, index=True)  # range filtered by getNumberOfRegistredUsers
     histories = relationship("History", back_populates="user", cascade="all, delete-orphan")
 
     def __init__(
@@ -28,7 +52,7 @@ class User(Base):
         registration_date,
     ):
         self.id = username
-        self.password =  bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.password = hash_password(password)
         self.first_name = first_name
         self.last_name = last_name
         self.date_of_birth = date_of_birth
@@ -64,6 +88,11 @@ class MediaItem(Base):
 
 class History(Base):
     __tablename__ = "History"
+    __table_args__ = (
+        # a user's history in time order, and who watched an item
+        Index("ix_history_user_viewtime", "user_id", "viewtime"),
+        Index("ix_history_media_item", "media_item_id", "user_id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(255), ForeignKey('Users.id'), nullable=False)
@@ -77,54 +106,239 @@ class History(Base):
         self.media_item_id = media_item_id
         self.viewtime = viewtime
 
+# repositories with cached fields, weakly held so that the session listeners below don't keep them alive
+_caching_repositories = weakref.WeakSet()
+
+
+def _invalidate_flushed(session, flush_context):
+    entities = list(session.dirty) + list(session.deleted)
+    if not entities:
+        return
+    # repositories over the same model and fields share one check
+    checked = {}
+    for repository in list(_caching_repositories):
+        key = (repository.model_class, repository.cached_fields)
+        if key not in checked:
+            checked[key] = repository._changed_ids(session, entities)
+        changed = checked[key]
+        for entity_id in changed:
+            repository.invalidate(entity_id)
+        if changed:
+            session.info.setdefault("changed_fields", []).append((weakref.ref(repository), changed))
+
+
+def _invalidate_committed(session):
+    # once more after the commit, another session may have cached the old values in between
+    for repository_ref, changed in session.info.pop("changed_fields", ()):
+        repository = repository_ref()
+        if repository is not None:
+            for entity_id in changed:
+                repository.invalidate(entity_id)
+
+
+def _forget_changed(session, previous_transaction):
+    session.info.pop("changed_fields", None)
+
+
+event.listen(Session, "after_flush", _invalidate_flushed)
+event.listen(Session, "after_commit", _invalidate_committed)
+event.listen(Session, "after_soft_rollback", _forget_changed)
+
+
 class Repository:
-    def __init__(self, model_class):
+    def __init__(self, model_class, cached_fields=(), cache_size=10000, cache_ttl=300.0):
         self.model_class=model_class
+        # fields cached across sessions, dropped whenever any session flushes a change to them
+        self.cached_fields = tuple(cached_fields)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._field_cache = OrderedDict()  # id -> (expires at, {field: value}), least recently used first
+        self._cache_lock = threading.Lock()
+        if self.cached_fields:
+            _caching_repositories.add(self)
 
     def get_by_id(self, session, entity_id):
-        return session.query(self.model_class).filter(self.model_class.id == entity_id).first()
+        # no query when the entity is already in the session's identity map
+        return session.get(self.model_class, entity_id)
+
+    def get_many(self, session, entity_ids) -> dict:
+        found = {}
+        missing = []
+        for entity_id in dict.fromkeys(entity_ids):
+            entity = session.identity_map.get(identity_key(self.model_class, entity_id))
+            # expired entities would be refreshed one by one, load them with the rest instead
+            if entity is not None and not inspect(entity).expired_attributes:
+                found[entity_id] = entity
+            else:
+                missing.append(entity_id)
+        # per 1000 ids to stay well below the 2100 parameter limit of SQL Server
+        for chunk in batches(missing, 1000):
+            for entity in session.query(self.model_class).filter(self.model_class.id.in_(chunk)):
+                found[entity.id] = entity
+        return found
+
+    def get_fields(self, session, entity_id):
+        # the cached fields of an entity as a dict, None if it doesn't exist
+        with self._cache_lock:
+            entry = self._field_cache.get(entity_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._field_cache.move_to_end(entity_id)
+                return entry[1]
+
+        row = (
+            session.query(*[getattr(self.model_class, field) for field in self.cached_fields])
+            .filter(self.model_class.id == entity_id)
+            .first()
+        )
+        if row is None:
+            return None
+        fields = dict(zip(self.cached_fields, row))
+        with self._cache_lock:
+            self._field_cache[entity_id] = (time.monotonic() + self.cache_ttl, fields)
+            self._field_cache.move_to_end(entity_id)
+            while len(self._field_cache) > self.cache_size:
+                self._field_cache.popitem(last=False)
+        return fields
+
+    def invalidate(self, entity_id):
+        with self._cache_lock:
+            self._field_cache.pop(entity_id, None)
+
+    def _changed_ids(self, session, entities) -> set:
+        # ids of flushed entities that were deleted or had a cached field changed
+        changed = set()
+        for entity in entities:
+            if not isinstance(entity, self.model_class):
+                continue
+            state = inspect(entity)
+            if entity in session.deleted or any(
+                state.attrs[field].history.has_changes() for field in self.cached_fields
+            ):
+                changed.add(entity.id)
+        return changed
     
     def get_all(self,session):
         return session.query(self.model_class).all()
+
+    def iter_all(self, session, batch_size=1000, columns=None):
+        # keyset pagination on the primary key: every page is a range seek and only one page is held.
+        # with columns, rows are (id, *columns) tuples instead of full entities
+        key = self.model_class.id
+        entities = [key] + [column for column in columns if column is not key] if columns else [self.model_class]
+        last_id = None
+        while True:
+            query = session.query(*entities)
+            if last_id is not None:
+                query = query.filter(key > last_id)
+            page = query.order_by(key).limit(batch_size).all()
+            yield from page
+            if len(page) < batch_size:
+                return
+            last_id = page[-1].id
+
+    def stream_all(self, session, batch_size=1000):
+        # one query read through a server-side cursor, batch_size rows at a time
+        return session.query(self.model_class).execution_options(stream_results=True).yield_per(batch_size)
     
     def delete(self,session, entity):
+        self.invalidate(entity.id)
         session.delete(entity)
 
     def add(self, session, entity):
+        if entity.id is not None:
+            self.invalidate(entity.id)
         session.add(entity)
 
 
 class UserRepository(Repository):
-    def __init__(self):
-        super().__init__(User)
+    def __init__(self, validation_ttl: float = 300.0, validation_cache_size: int = 10000):
+        super().__init__(User, cached_fields=("password", "registration_date"))
+        # recently verified credentials, so repeat validations skip bcrypt
+        self.validation_ttl = validation_ttl
+        self.validation_cache_size = validation_cache_size
+        # (username, keyed digest of the password) -> (password hash, expires at), least recently used first
+        self._validated = OrderedDict()
+        self._secret = secrets.token_bytes(32)
    
     def validateUser(self,session, username: str, password: str) -> bool:
-        user = session.query(self.model_class).filter(self.model_class.id == username).first()
-
-        if not user:
-            return False
-
-        if bcrypt.checkpw(password.encode('utf-8'), user.password):
-            return True
-
-        return False
+        return self.verifyCredentials(session, username, password)[0]
+
+    def verifyCredentials(self, session, username: str, password: str) -> tuple:
+        # (valid, rehashed) - rehashed means the user's password was upgraded in the session and needs a commit
+        fields = self.get_fields(session, username)
+
+        if not fields:
+            return False, False
+
+        hashed = fields["password"]
+        key = (username, hmac.new(self._secret, password.encode('utf-8'), hashlib.sha256).digest())
+        with self._cache_lock:
+            cached = self._validated.get(key)
+            if cached is not None:
+                self._validated.move_to_end(key)
+        # only valid while the stored hash is the one that was verified
+        if cached and cached[0] == hashed and cached[1] > time.monotonic():
+            return True, False
+
+        if not bcrypt.checkpw(password.encode('utf-8'), hashed):
+            return False, False
+
+        # hashes made with another work factor are upgraded, the service commits it
+        rehashed = int(hashed.split(b'$')[2]) != BCRYPT_ROUNDS
+        if rehashed:
+            user = self.get_by_id(session, username)
+            user.password = hashed = hash_password(password)
+            self.invalidate(username)
+
+        with self._cache_lock:
+            self._validated[key] = (hashed, time.monotonic() + self.validation_ttl)
+            self._validated.move_to_end(key)
+            while len(self._validated) > self.validation_cache_size:
+                self._validated.popitem(last=False)
+        return True, rehashed
 
     def getNumberOfRegistredUsers(self,session, n: int) -> int:
         start_date = (datetime.now() - timedelta(days=n)).date()
         return session.query(User).filter(User.registration_date >= start_date).count()
+
+    def getTitleLengthSums(self, session, usernames) -> dict:
+        # one JOIN ... GROUP BY instead of loading every history and media item,
+        # per 1000 users to stay well below the 2100 parameter limit of SQL Server
+        lengths = {}
+        for chunk in batches(dict.fromkeys(usernames), 1000):
+            rows = (
+                session.query(User.id, func.coalesce(func.sum(MediaItem.title_length), 0))
+                .outerjoin(History, History.user_id == User.id)
+                .outerjoin(MediaItem, MediaItem.id == History.media_item_id)
+                .filter(User.id.in_(chunk))
+                .group_by(User.id)
+                .all()
+            )
+            lengths.update(rows)
+        return lengths
     
 class ItemRepository(Repository):
     def __init__(self):
         super().__init__(MediaItem)
 
-    def getTopNItems(self, session, top_n: int) -> list:
-        return session.query(MediaItem).order_by(MediaItem.id.asc()).limit(top_n).all()
+    def getTopNItems(self, session, top_n: int, after_id: int = None) -> list:
+        query = session.query(MediaItem)
+        # continue after the last id of the previous page
+        if after_id is not None:
+            query = query.filter(MediaItem.id > after_id)
+        return query.order_by(MediaItem.id.asc()).limit(top_n).all()
+
+
+class HistoryRepository(Repository):
+    def __init__(self):
+        super().__init__(History)
 
 
     
 class UserService:
-    def __init__(self, session, user_repo: UserRepository):
+    def __init__(self, session, user_repo: UserRepository, history_repo: HistoryRepository = None):
         self.user_repo = user_repo
+        self.history_repo = history_repo if history_repo is not None else HistoryRepository()
         self.session = session
 
     def create_user(self, username, password, first_name, last_name, date_of_birth):
@@ -139,28 +353,68 @@ class UserService:
         self.user_repo.add(self.session, new_user)
         self.session.commit()
 
+    def create_users(self, users, batch_size=1000, workers=4) -> dict:
+        # users are (username, password, first_name, last_name, date_of_birth) tuples
+        start = time.perf_counter()
+        inserted = 0
+        with ThreadPoolExecutor(workers) as executor:
+            for batch in batches(users, batch_size):
+                # bcrypt releases the GIL, so the hashes of a batch run in parallel
+                hashes = executor.map(hash_password, [user[1] for user in batch])
+                registration_date = datetime.now()
+                self.session.execute(insert(User), [
+                    {
+                        "id": username,
+                        "password": hashed,
+                        "first_name": first_name,
+                        "last_name": last_name,
+                        "date_of_birth": date_of_birth,
+                        "registration_date": registration_date,
+                    }
+                    for (username, _, first_name, last_name, date_of_birth), hashed in zip(batch, hashes)
+                ])
+                self.session.commit()
+                inserted += len(batch)
+        elapsed = time.perf_counter() - start
+        return {"inserted": inserted, "seconds": elapsed, "rows_per_sec": inserted / elapsed if elapsed > 0 else 0.0}
+
     def add_history_to_user(self, username, media_item_id):
-        user = self.user_repo.get_by_id(self.session, username)
-        if not user:
+        # insert the row on its own instead of loading the user and its histories collection
+        if not self.user_repo.get_fields(self.session, username):
             raise ValueError("User not found")
-        user.add_history(media_item_id)
-        self.session.commit()
+        self.history_repo.add(self.session, History(username, media_item_id, datetime.now()))
+        try:
+            self.session.commit()
+        except IntegrityError:
+            # the foreign keys reject a user deleted meanwhile or an unknown media item
+            self.session.rollback()
+            raise ValueError("User or media item not found")
     
     def validateUser(self, username: str, password: str) -> bool:
-        return self.user_repo.validateUser(self.session, username, password)
+        valid, rehashed = self.user_repo.verifyCredentials(self.session, username, password)
+        # store a rehashed password
+        if rehashed:
+            self.session.commit()
+        return valid
 
     def getNumberOfRegistredUsers(self, n: int) -> int:
         return  self.user_repo.getNumberOfRegistredUsers(self.session, n)
     
     def sum_title_length_to_user(self, username):
-        user = self.user_repo.get_by_id(self.session,  username)
-        if not user:
+        return self.sum_title_length_for_users([username])[username]
+
+    def sum_title_length_for_users(self, usernames) -> dict:
+        lengths = self.user_repo.getTitleLengthSums(self.session, usernames)
+        if len(lengths) < len(set(usernames)):
             raise ValueError("User not found")
-        return user.sum_title_length()
+        return lengths
 
     def get_all_users(self):
         return self.user_repo.get_all(self.session)
 
+    def iter_users(self, batch_size=1000):
+        return self.user_repo.iter_all(self.session, batch_size)
+
     
 class ItemService:
     def __init__(self, session, item_repo:ItemRepository):
@@ -172,6 +426,20 @@ class ItemService:
         self.item_repo.add(self.session, new_item)
         self.session.commit()
 
+    def create_items(self, items, batch_size=1000) -> dict:
+        # items are (title, prod_year) tuples, one executemany INSERT and commit per batch
+        start = time.perf_counter()
+        inserted = 0
+        for batch in batches(items, batch_size):
+            self.session.execute(insert(MediaItem), [
+                {"title": title, "prod_year": prod_year, "title_length": len(title)}
+                for title, prod_year in batch
+            ])
+            self.session.commit()
+            inserted += len(batch)
+        elapsed = time.perf_counter() - start
+        return {"inserted": inserted, "seconds": elapsed, "rows_per_sec": inserted / elapsed if elapsed > 0 else 0.0}
+
 
 
 if __name__ == '__main__':
@@ -213,14 +481,10 @@ if __name__ == '__main__':
     # with open(csv_file_path, mode='r', encoding='utf-8') as file:
     #     reader = csv.reader(file)  # Read rows as lists
     #
-    #     for row in reader:
-    #         title = row[0]  # First column is the title
-    #         prod_date = int(row[1])  # Second column is the production date
-    #
-    #         # Call the item_service to create items
-    #         item_service.create_item(title, prod_date)
+    #     # First column is the title, second column is the production date
+    #     stats = item_service.create_items((row[0], int(row[1])) for row in reader)
     #
-    # print("Items created successfully from the CSV.")
+    # print(f"Items created successfully from the CSV ({stats['rows_per_sec']:.0f} rows/sec).")
     user_service = UserService(session, UserRepository())
 
     # # add users to DB
@@ -270,9 +534,10 @@ if __name__ == '__main__':
     print(user_service.getNumberOfRegistredUsers(3))
     print(user_service.getNumberOfRegistredUsers(10))
 
-    print(user_service.get_all_users())
+    for user in user_service.iter_users():
+        print(user)
     print(item_service.item_repo.getTopNItems(session, 10))
-    for username in usernames:
-        print(f'{username}:{user_service.sum_title_length_to_user(username)}')
+    for username, length in user_service.sum_title_length_for_users(usernames).items():
+        print(f'{username}:{length}')
     x=0
 
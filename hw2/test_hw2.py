@@ -0,0 +1,58 @@
+import unittest
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import sessionmaker
+
+import hw2
+
+
+class AddHistoryQueryCountTest(unittest.TestCase):
+    def setUp(self):
+        hw2.BCRYPT_ROUNDS = 4
+        self.engine = create_engine("sqlite://")
+        event.listen(self.engine, "connect", lambda connection, record: connection.execute("PRAGMA foreign_keys=ON"))
+        hw2.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.user_service = hw2.UserService(self.session, hw2.UserRepository())
+        hw2.ItemService(self.session, hw2.ItemRepository()).create_items([("Alien", 1979), ("Heat", 1995)])
+        self.user_service.create_user("user1", "password", "First", "Last", datetime(1990, 1, 1))
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self._record)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def _record(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement.split()[0].upper())
+
+    def test_add_history_is_a_single_insert(self):
+        # the first call reads the user's cached fields, after that only the INSERT is left
+        self.user_service.add_history_to_user("user1", 1)
+        self.statements.clear()
+        for media_item_id in (1, 2, 2):
+            self.user_service.add_history_to_user("user1", media_item_id)
+        self.assertEqual(self.statements, ["INSERT"] * 3)
+        self.assertEqual(self.user_service.sum_title_length_to_user("user1"), 5 + 4 + 4 + 5)
+
+    def test_add_history_does_not_load_the_histories_collection(self):
+        self.user_service.add_history_to_user("user1", 1)
+        self.assertEqual(self.statements.count("SELECT"), 1)
+
+    def test_unknown_user_or_item_raises(self):
+        with self.assertRaises(ValueError):
+            self.user_service.add_history_to_user("nobody", 1)
+        with self.assertRaises(ValueError):
+            self.user_service.add_history_to_user("user1", 99)
+
+    def test_indexes_exist(self):
+        history_indexes = {index["name"]: index["column_names"] for index in inspect(self.engine).get_indexes("History")}
+        self.assertEqual(history_indexes["ix_history_user_viewtime"], ["user_id", "viewtime"])
+        self.assertEqual(history_indexes["ix_history_media_item"], ["media_item_id", "user_id"])
+        user_indexes = [index["column_names"] for index in inspect(self.engine).get_indexes("Users")]
+        self.assertIn(["registration_date"], user_indexes)
+
+
+if __name__ == "__main__":
+    unittest.main()
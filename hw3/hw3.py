@@ -2,23 +2,371 @@ import csv
 from multiprocessing.managers import Value
 
 import pymongo
+import pymongo.errors
 import bcrypt
 import ast
+import os
+import pickle
+import numpy as np
 import pandas as pd
 import random
+import secrets
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from sqlalchemy import false
 
 
-class LoginManager:
+def inserted_games(games: list, error: pymongo.errors.BulkWriteError) -> list:
+    # titles inserted meanwhile by another loader are rejected by the unique index, any other error is re-raised
+    write_errors = error.details['writeErrors']
+    if any(write_error['code'] != 11000 for write_error in write_errors):
+        raise error
+    failed = {write_error['index'] for write_error in write_errors}
+    return [game for i, game in enumerate(games) if i not in failed]
+
+
+def parse_genres(value) -> list:
+    # fast path for plain "['A', 'B']" lists, anything quoted differently goes through literal_eval
+    if not isinstance(value, str):
+        return []
+    value = value.strip()
+    if value == "[]":
+        return []
+    if value.startswith("['") and value.endswith("']") and '"' not in value and "\\" not in value:
+        return value[2:-2].split("', '")
+    return ast.literal_eval(value)
+
+
+def top_k(candidates, scores, k: int) -> list:
+    # best k candidates by score, without sorting all of them
+    keep = np.isfinite(scores)
+    candidates, scores = candidates[keep], scores[keep]
+    k = min(k, len(scores))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return candidates[top].tolist()
+
+
+class ExactTitleBackend:
+    # brute force cosine similarity against every title
+
+    def fit(self, matrix) -> None:
+        self.matrix = matrix
+
+    def search(self, query, k: int, excluded) -> list:
+        scores = (self.matrix @ query.T).toarray().ravel()
+        scores[list(excluded)] = -np.inf
+        return top_k(np.arange(len(scores)), scores, k)
+
+
+class LSHTitleBackend:
+    # random hyperplane LSH: titles sharing a bucket in any table are re-ranked exactly.
+    # more tables raise recall, more bits per table shrink the buckets and the latency
+
+    def __init__(self, n_tables: int = 16, n_bits: int = 6, seed: int = 0) -> None:
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+
+    def fit(self, matrix) -> None:
+        self.matrix = matrix
+        rng = np.random.default_rng(self.seed)
+        self.planes = rng.standard_normal((matrix.shape[1], self.n_tables * self.n_bits))
+        self.tables = []
+        for table, codes in enumerate(self._codes(matrix).T):
+            buckets = {}
+            for position, code in enumerate(codes.tolist()):
+                buckets.setdefault(code, []).append(position)
+            self.tables.append({code: np.array(positions) for code, positions in buckets.items()})
+
+    def _codes(self, vectors):
+        # one integer bucket code per table
+        bits = np.asarray(vectors @ self.planes) > 0
+        bits = bits.reshape(-1, self.n_tables, self.n_bits)
+        return bits.dot(1 << np.arange(self.n_bits))
+
+    def search(self, query, k: int, excluded) -> list:
+        codes = self._codes(query)[0]
+        found = [self.tables[table].get(code) for table, code in enumerate(codes.tolist())]
+        found = [positions for positions in found if positions is not None]
+        if not found:
+            return []
+        candidates = np.unique(np.concatenate(found))
+        candidates = candidates[~np.isin(candidates, list(excluded))]
+        scores = (self.matrix[candidates] @ query.T).toarray().ravel()
+        return top_k(candidates, scores, k)
+
+
+def benchmark_title_backends(index: 'TitleIndex', backend, sample_size: int = 200, k: int = 5, seed: int = 0) -> dict:
+    # recall@k and latency of backend against the exact search, querying with titles from the index
+    exact = ExactTitleBackend()
+    exact.fit(index.matrix)
+    backend.fit(index.matrix)
+    rng = random.Random(seed)
+    sample = rng.sample(range(len(index.titles)), min(sample_size, len(index.titles)))
+
+    recalls = []
+    exact_time = 0.0
+    backend_time = 0.0
+    for position in sample:
+        query = index.vectorizer.transform([index.titles[position]])
+        start = time.perf_counter()
+        expected = exact.search(query, k, {position})
+        exact_time += time.perf_counter() - start
+        start = time.perf_counter()
+        got = backend.search(query, k, {position})
+        backend_time += time.perf_counter() - start
+        # titles sharing no word with the query are arbitrary ties, leave them out
+        scores = (index.matrix[expected] @ query.T).toarray().ravel() if expected else []
+        relevant = {p for p, score in zip(expected, scores) if score > 0}
+        if relevant:
+            recalls.append(len(relevant & set(got)) / len(relevant))
+
+    return {
+        f'recall@{k}': sum(recalls) / len(recalls) if recalls else 0.0,
+        'exact_ms': 1000 * exact_time / len(sample) if sample else 0.0,
+        'backend_ms': 1000 * backend_time / len(sample) if sample else 0.0,
+        'queries': len(sample),
+    }
+
+
+class TitleIndex:
+    # fitted TF-IDF vectors of every game title, rows are l2-normalized so a dot product is the cosine
+
+    def __init__(self, backend=None) -> None:
+        self.backend = backend if backend is not None else ExactTitleBackend()
+        self.vectorizer = None
+        self.matrix = None
+        self.ids = []
+        self.titles = []
+        self.positions = {}
+        # (number of games, largest _id) of the collection the index was built from
+        self.fingerprint = None
+
+    def build(self, games) -> None:
+        games = list(games)
+        self.ids = [game['_id'] for game in games]
+        self.titles = [game['title'] for game in games]
+        self.positions = {game_id: i for i, game_id in enumerate(self.ids)}
+        self.fingerprint = (len(self.ids), max(self.ids) if self.ids else None)
+        if not self.titles:
+            return
+        self.vectorizer = TfidfVectorizer()
+        self.matrix = self.vectorizer.fit_transform(self.titles).tocsr()
+        self.backend.fit(self.matrix)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'index.pkl'), 'wb') as file:
+            pickle.dump((self.vectorizer, self.ids, self.titles, self.matrix.shape, self.fingerprint), file)
+        np.save(os.path.join(path, 'data.npy'), self.matrix.data)
+        np.save(os.path.join(path, 'indices.npy'), self.matrix.indices)
+        np.save(os.path.join(path, 'indptr.npy'), self.matrix.indptr)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, backend=None) -> 'TitleIndex':
+        mmap_mode = 'r' if mmap else None
+        index = cls(backend)
+        with open(os.path.join(path, 'index.pkl'), 'rb') as file:
+            saved = pickle.load(file)
+        # indexes saved before fingerprints have none and never match the collection
+        index.vectorizer, index.ids, index.titles, shape = saved[:4]
+        index.fingerprint = saved[4] if len(saved) > 4 else None
+        index.positions = {game_id: i for i, game_id in enumerate(index.ids)}
+        index.matrix = csr_matrix((
+            np.load(os.path.join(path, 'data.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'indices.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'indptr.npy'), mmap_mode=mmap_mode),
+        ), shape=shape, copy=False)
+        index.backend.fit(index.matrix)
+        return index
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, 'index.pkl'))
+
+    def most_similar(self, title: str, k: int = 5, exclude_ids=()) -> list:
+        if self.matrix is None:
+            return []
+        query = self.vectorizer.transform([title])
+        # excluded games can never be picked
+        excluded = {self.positions[game_id] for game_id in exclude_ids if game_id in self.positions}
+        return [self.titles[i] for i in self.backend.search(query, k, excluded)]
+
+
+class GenreIndex:
+    # per-genre pools of game ids, kept in memory so genre queries need no aggregation
 
     def __init__(self) -> None:
+        self.game_genres = {}  # game id -> genres
+        self.titles = {}  # game id -> title
+        self.pools = {}  # genre -> game ids
+
+    def add(self, games) -> None:
+        for game in games:
+            if game['_id'] in self.game_genres:
+                continue
+            genres = game.get('genres') or []
+            self.game_genres[game['_id']] = genres
+            self.titles[game['_id']] = game['title']
+            for genre in genres:
+                self.pools.setdefault(genre, []).append(game['_id'])
+
+    def distribution(self) -> dict:
+        return {genre: len(game_ids) for genre, game_ids in self.pools.items()}
+
+    def genre_counts(self, game_ids) -> dict:
+        counts = {}
+        for game_id in game_ids:
+            for genre in self.game_genres.get(game_id, []):
+                counts[genre] = counts.get(genre, 0) + 1
+        return counts
+
+    def sample(self, genre: str, k: int) -> list:
+        pool = self.pools.get(genre, [])
+        return [self.titles[game_id] for game_id in random.sample(pool, min(k, len(pool)))]
+
+
+class RentalResult(namedtuple('RentalResult', ['title', 'status', 'game_id', 'message'])):
+    # outcome of renting or returning one game, prints as the message
+
+    def __str__(self) -> str:
+        return self.message
+
+
+def rent_results(game_titles: list, games: dict, rented_ids) -> list:
+    results = []
+    for game_title in game_titles:
+        game = games.get(game_title)
+        if not game:
+            results.append(RentalResult(game_title, 'not_found', None, f"{game_title} not found"))
+        elif game['_id'] in rented_ids:
+            results.append(RentalResult(game_title, 'rented', game['_id'], f"{game_title} rented successfully"))
+        else:
+            results.append(RentalResult(game_title, 'already_rented', None, f"{game_title} is already rented"))
+    return results
+
+
+def return_results(game_titles: list, games: dict, returned_ids) -> list:
+    results = []
+    for game_title in game_titles:
+        game = games.get(game_title)
+        if not game:
+            results.append(RentalResult(game_title, 'not_found', None, "failure"))
+        elif game['_id'] in returned_ids:
+            results.append(RentalResult(game_title, 'returned', game['_id'], f"{game_title} returned successfully"))
+        else:
+            results.append(RentalResult(game_title, 'not_rented', None, f"{game_title} was not rented by you"))
+    return results
+
+
+def plan_stages(plan) -> list:
+    # every stage name in an explain() plan tree
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def explain_queries(queries: dict) -> dict:
+    # name -> (collection, filter); flags the queries that would scan the whole collection
+    report = {}
+    for name, (collection, query) in queries.items():
+        try:
+            stages = plan_stages(collection.find(query).explain()['queryPlanner']['winningPlan'])
+        except AttributeError:
+            # drivers without explain (mongomock) - check for an index on the filtered field instead
+            indexed = {info['key'][0][0] for info in collection.index_information().values()}
+            stages = ['IXSCAN' if next(iter(query)) in indexed else 'COLLSCAN']
+        report[name] = {'stages': stages, 'collection_scan': 'COLLSCAN' in stages}
+    return report
+
+
+# the salt every password was hashed with before per-user salts, such hashes are upgraded on login
+LEGACY_SALT = b"$2b$12$ezgTynDsK3pzF8SStLuAPO"
+
+
+class CredentialVerifier:
+    # bcrypt with a per-user salt and a configurable cost, inline or on a thread pool for the async manager,
+    # plus short-lived session tokens so repeat validations skip bcrypt
+
+    def __init__(self, rounds: int = 12, workers: int = 4, session_ttl: float = 300.0) -> None:
+        self.rounds = rounds
+        self.session_ttl = session_ttl
+        self.executor = ThreadPoolExecutor(workers)
+        self._sessions = {}  # token -> (username, expires at)
+        self._lock = threading.Lock()
+
+    def submit_hash(self, password: str):
+        return self.executor.submit(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+
+    def submit_verify(self, password: str, hashed: bytes):
+        return self.executor.submit(bcrypt.checkpw, password.encode('utf-8'), bytes(hashed))
+
+    def hash(self, password: str) -> bytes:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+
+    def verify(self, password: str, hashed: bytes) -> bool:
+        return bcrypt.checkpw(password.encode('utf-8'), bytes(hashed))
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        # bcrypt hashes look like $2b$<cost>$<salt and hash>
+        hashed = bytes(hashed)
+        return hashed.startswith(LEGACY_SALT) or int(hashed.split(b'$')[2]) != self.rounds
+
+    def create_session(self, username: str) -> str:
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self._lock:
+            # drop expired sessions that were never validated again
+            if len(self._sessions) >= 10000:
+                self._sessions = {t: entry for t, entry in self._sessions.items() if entry[1] >= now}
+            self._sessions[token] = (username, now + self.session_ttl)
+        return token
+
+    def validate_session(self, token: str):
+        # the username of a live session, None otherwise
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if session[1] < time.monotonic():
+                del self._sessions[token]
+                return None
+            return session[0]
+
+    def end_session(self, token: str) -> None:
+        with self._lock:
+            self._sessions.pop(token, None)
+
+
+class LoginManager:
+
+    def __init__(self, rounds: int = 12, session_ttl: float = 300.0) -> None:
         # MongoDB connection
         self.client = pymongo.MongoClient("mongodb://localhost:27017/")
         self.db = self.client["hw3"]
         self.collection = self.db["users"]
-        self.salt = b"$2b$12$ezgTynDsK3pzF8SStLuAPO"  # TODO: if not working, generate a new salt
+        self.verifier = CredentialVerifier(rounds, session_ttl=session_ttl)
+        self.ensure_indexes()
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index('username', unique=True)
+
+    def explain_hot_queries(self) -> dict:
+        return explain_queries({'user_by_username': (self.collection, {'username': ''})})
 
     def register_user(self, username: str, password: str) -> None:
         if not username or not password:
@@ -30,107 +378,284 @@ class LoginManager:
         if self.collection.find_one({"username": username}):
             raise ValueError(f"User already exists: {username}.")
 
-        hashed_pass = bcrypt.hashpw(password.encode('utf-8'), self.salt)
-        self.collection.insert_one({"username": username, "password": hashed_pass})
+        hashed_pass = self.verifier.hash(password)
+        try:
+            self.collection.insert_one({"username": username, "password": hashed_pass})
+        except pymongo.errors.DuplicateKeyError:
+            # registered concurrently after the check above, the unique index rejected this one
+            raise ValueError(f"User already exists: {username}.")
 
     def login_user(self, username: str, password: str) -> object:
-        hashed_pass = bcrypt.hashpw(password.encode('utf-8'), self.salt)
-        user = self.collection.find_one({"username": username, "password": hashed_pass})
-        if user is not None:
-            print(f"Logged in successfully as: {username}")
-        else:
+        user = self.collection.find_one({"username": username}, {"password": 1})
+        # the salt is stored in the hash itself, so hashes made with the old global salt still verify
+        if user is None or not self.verifier.verify(password, user["password"]):
             raise ValueError("Invalid username or password")
-        pass
+
+        # the work factor changed since this hash was made - upgrade it now that we know the password
+        if self.verifier.needs_rehash(user["password"]):
+            self.collection.update_one({"_id": user["_id"]}, {"$set": {"password": self.verifier.hash(password)}})
+
+        print(f"Logged in successfully as: {username}")
+        return self.verifier.create_session(username)
+
+    def validate_session(self, token: str):
+        return self.verifier.validate_session(token)
+
+    def logout_user(self, token: str) -> None:
+        self.verifier.end_session(token)
 
 
 class DBManager:
 
-    def __init__(self) -> None:
+    def __init__(self, title_index_path: str = None, title_backend=None) -> None:
         # MongoDB connection
         self.client = pymongo.MongoClient("mongodb://localhost:27017/")
         self.db = self.client["hw3"]
         self.user_collection = self.db["users"]
         self.game_collection = self.db["games"]
-
-    def load_csv(self) -> None:
-        csv_file = 'NintendoGames.csv'
-        data = pd.read_csv(csv_file)
-
-        data['user_score'] = data['user_score'].astype(float)
-        data['genres'] = data['genres'].apply(ast.literal_eval)
-        data['is_rented'] = False
-        # make sure that there are no duplicates
-        games_to_add = []
-        for _, row in data.iterrows():
-            game_data = row.to_dict()
-            if not self.game_collection.find_one({'title': game_data['title']}):
+        # title index for recommend_games_by_name, built on first use
+        self.title_index_path = title_index_path
+        self.title_backend = title_backend
+        self.title_index = None
+        # genre pools for genre recommendations and distribution, built on first use
+        self.genre_index = None
+        # per-platform (score sum, scored games) documents behind get_average_score_per_platform
+        self.platform_stats = self.db["platform_stats"]
+        self.ensure_indexes()
+
+    def ensure_indexes(self) -> None:
+        self.user_collection.create_index('username', unique=True)
+        self.game_collection.create_index('title', unique=True)
+        self.game_collection.create_index('platform')
+        self.game_collection.create_index('user_score')
+        # multikey, one entry per genre of a game
+        self.game_collection.create_index('genres')
+
+    def explain_hot_queries(self) -> dict:
+        return explain_queries({
+            'user_by_username': (self.user_collection, {'username': ''}),
+            'game_by_title': (self.game_collection, {'title': ''}),
+            'top_rated_games': (self.game_collection, {'user_score': {'$gte': 0}}),
+            'games_by_platform': (self.game_collection, {'platform': ''}),
+            'games_by_genre': (self.game_collection, {'genres': ''}),
+        })
+
+    def load_csv(self, csv_file: str = 'NintendoGames.csv', batch_size: int = 1000) -> None:
+        start = time.perf_counter()
+        # make sure that there are no duplicates - fetch the existing titles once
+        existing_titles = set(self.game_collection.distinct('title'))
+        # platform stats can be kept up to date incrementally only if they cover the existing games
+        track_stats = not existing_titles or self.platform_stats.estimated_document_count() > 0
+
+        inserted = 0
+        for chunk in pd.read_csv(csv_file, chunksize=batch_size):
+            chunk['user_score'] = chunk['user_score'].astype(float)
+            chunk['genres'] = chunk['genres'].map(parse_genres)
+            chunk['is_rented'] = False
+
+            games_to_add = []
+            for game_data in chunk.to_dict('records'):
+                if game_data['title'] in existing_titles:
+                    continue
+                existing_titles.add(game_data['title'])
                 games_to_add.append(game_data)
-        # insert the remaining records
-        if games_to_add:
-            self.game_collection.insert_many(games_to_add)
-
-    def rent_game(self, user: dict, game_title: str) -> str:
-        game = self.game_collection.find_one({'title': game_title})
+            # insert the remaining records of this chunk
+            if games_to_add:
+                try:
+                    self.game_collection.insert_many(games_to_add, ordered=False)
+                except pymongo.errors.BulkWriteError as e:
+                    games_to_add = inserted_games(games_to_add, e)
+                inserted += len(games_to_add)
+                if track_stats and games_to_add:
+                    self._add_platform_stats(games_to_add)
+                # insert_many filled in the _id of each game
+                if self.genre_index is not None:
+                    self.genre_index.add(games_to_add)
+
+        elapsed = time.perf_counter() - start
+        rate = inserted / elapsed if elapsed > 0 else 0.0
+        print(f"{inserted} games were inserted in {elapsed:.2f}s ({rate:.0f} games/sec)")
+
+        if inserted and not track_stats:
+            self.rebuild_platform_stats()
+
+        # keep the title index in line with the new games
+        if inserted and (self.title_index is not None or self.title_index_path):
+            self.rebuild_title_index()
+
+    def rebuild_title_index(self) -> None:
+        index = TitleIndex(self.title_backend)
+        index.build(self.game_collection.find({}, {'title': 1}))
+        if self.title_index_path and index.matrix is not None:
+            index.save(self.title_index_path)
+        self.title_index = index
+
+    def games_fingerprint(self) -> tuple:
+        # changes whenever the collection is reloaded, since new games get new ObjectIds
+        last = self.game_collection.find_one({}, {'_id': 1}, sort=[('_id', pymongo.DESCENDING)])
+        return self.game_collection.count_documents({}), last['_id'] if last else None
+
+    def get_title_index(self) -> TitleIndex:
+        if self.title_index is None:
+            if self.title_index_path and TitleIndex.exists(self.title_index_path):
+                index = TitleIndex.load(self.title_index_path, backend=self.title_backend)
+                # a saved index of an older collection would not know the rented ids
+                if index.fingerprint == self.games_fingerprint():
+                    self.title_index = index
+            if self.title_index is None:
+                self.rebuild_title_index()
+        return self.title_index
+
+    def rebuild_platform_stats(self) -> None:
+        # one document per platform, written back with upserts instead of $merge
+        stats = list(self.game_collection.aggregate([
+            {'$group': {
+                '_id': '$platform',
+                'score_sum': {'$sum': '$user_score'},
+                'scored_games': {'$sum': {'$cond': [{'$isNumber': '$user_score'}, 1, 0]}}
+            }}
+        ]))
+        if stats:
+            self.platform_stats.bulk_write([
+                pymongo.ReplaceOne({'_id': stat['_id']}, stat, upsert=True) for stat in stats
+            ], ordered=False)
+
+    def _add_platform_stats(self, games: list) -> None:
+        totals = {}
+        for game in games:
+            if isinstance(game.get('user_score'), (int, float)):
+                total = totals.setdefault(game['platform'], [0.0, 0])
+                total[0] += game['user_score']
+                total[1] += 1
+        if totals:
+            self.platform_stats.bulk_write([
+                pymongo.UpdateOne(
+                    {'_id': platform},
+                    {'$inc': {'score_sum': score_sum, 'scored_games': scored_games}},
+                    upsert=True
+                )
+                for platform, (score_sum, scored_games) in totals.items()
+            ], ordered=False)
+
+    def get_genre_index(self) -> GenreIndex:
+        if self.genre_index is None:
+            index = GenreIndex()
+            index.add(self.game_collection.find({}, {'title': 1, 'genres': 1}))
+            self.genre_index = index
+        return self.genre_index
+
+    def rent_game(self, user: dict, game_title: str) -> RentalResult:
+        # claim the game only if it is free, in one atomic round trip
+        game = self.game_collection.find_one_and_update(
+            {'title': game_title, 'is_rented': {'$ne': True}},
+            {'$set': {'is_rented': True, 'rented_by': user['_id']}},
+            projection={'_id': 1}
+        )
 
         if not game:
-            return f"{game_title} not found"
+            if not self.game_collection.find_one({'title': game_title}, {'_id': 1}):
+                return RentalResult(game_title, 'not_found', None, f"{game_title} not found")
+            return RentalResult(game_title, 'already_rented', None, f"{game_title} is already rented")
+
+        try:
+            self.user_collection.update_one(
+                {'_id': user['_id']},
+                {'$push': {'rented_games_ids': game['_id']}}
+            )
+        except Exception:
+            # give the game back so it is not left rented by nobody
+            self.game_collection.update_one(
+                {'_id': game['_id']},
+                {'$set': {'is_rented': False}, '$unset': {'rented_by': ''}}
+            )
+            raise
 
-        if game.get('is_rented', False):
-            return f"{game_title} is already rented"
+        return RentalResult(game_title, 'rented', game['_id'], f"{game_title} rented successfully")
 
-        self.game_collection.update_one(
-            {'_id': game['_id']},
-            {'$set': {'is_rented': True}}
+    def return_game(self, user: dict, game_title: str) -> RentalResult:
+        # release the game only if it is rented by this user, in one atomic round trip
+        game = self.game_collection.find_one_and_update(
+            {'title': game_title, 'is_rented': True, '_id': {'$in': user.get('rented_games_ids', [])}},
+            {'$set': {'is_rented': False}, '$unset': {'rented_by': ''}},
+            projection={'_id': 1}
         )
 
+        if not game:
+            if not self.game_collection.find_one({'title': game_title}, {'_id': 1}):
+                return RentalResult(game_title, 'not_found', None, "failure")
+            return RentalResult(game_title, 'not_rented', None, f"{game_title} was not rented by you")
+
         self.user_collection.update_one(
-            {'_id': user['_id']},
-            {'$push': {'rented_games_ids': game['_id']}}
+            {"_id": user["_id"]},
+            {"$pull": {"rented_games_ids": game["_id"]}}
         )
+        return RentalResult(game_title, 'returned', game['_id'], f"{game_title} returned successfully")
+
+    def rent_games(self, user: dict, game_titles: list) -> list:
+        game_titles = list(dict.fromkeys(game_titles))
+        games = {game['title']: game for game in self.game_collection.find(
+            {'title': {'$in': game_titles}}, {'title': 1, 'is_rented': 1}
+        )}
+        free_ids = [game['_id'] for game in games.values() if not game.get('is_rented', False)]
+
+        # claim every free game at once, tagging the claim with the user
+        rented_ids = set()
+        if free_ids:
+            claimed = self.game_collection.update_many(
+                {'_id': {'$in': free_ids}, 'is_rented': {'$ne': True}},
+                {'$set': {'is_rented': True, 'rented_by': user['_id']}}
+            )
+            if claimed.modified_count == len(free_ids):
+                rented_ids = set(free_ids)
+            else:
+                # someone else got some of them first - find out which ones are ours
+                rented_ids = {game['_id'] for game in self.game_collection.find(
+                    {'_id': {'$in': free_ids}, 'rented_by': user['_id']}, {'_id': 1}
+                )}
+        if rented_ids:
+            self.user_collection.update_one(
+                {'_id': user['_id']},
+                {'$push': {'rented_games_ids': {'$each': [i for i in free_ids if i in rented_ids]}}}
+            )
 
-        return f"{game_title} rented successfully"
-
-    def return_game(self, user: dict, game_title: str) -> str:
-        game = self.game_collection.find_one({'title': game_title})
-
-        if not game:
-            return "failure"
-
-        if game.get("is_rented", False) and game["_id"] in user.get("rented_games_ids", []):
-            self.game_collection.update_one({"_id": game["_id"]}, {"$set": {"is_rented": False}})
+        return rent_results(game_titles, games, rented_ids)
+
+    def return_games(self, user: dict, game_titles: list) -> list:
+        game_titles = list(dict.fromkeys(game_titles))
+        games = {game['title']: game for game in self.game_collection.find(
+            {'title': {'$in': game_titles}}, {'title': 1, 'is_rented': 1}
+        )}
+        user_game_ids = set(user.get('rented_games_ids', []))
+        returned_ids = [game['_id'] for game in games.values()
+                        if game.get('is_rented', False) and game['_id'] in user_game_ids]
+
+        if returned_ids:
+            self.game_collection.update_many(
+                {'_id': {'$in': returned_ids}, 'is_rented': True},
+                {'$set': {'is_rented': False}, '$unset': {'rented_by': ''}}
+            )
             self.user_collection.update_one(
-                {"_id": user["_id"]},
-                {"$pull": {"rented_games_ids": game["_id"]}}
+                {'_id': user['_id']},
+                {'$pull': {'rented_games_ids': {'$in': returned_ids}}}
             )
-            return f"{game_title} returned successfully"
 
-        return f"{game_title} was not rented by you"
+        return return_results(game_titles, games, returned_ids)
 
     def recommend_games_by_genre(self, user: dict) -> list:
         rented_game_ids = user.get('rented_games_ids', [])
         if not rented_game_ids:
             return ["No games rented"]
+        index = self.get_genre_index()
         # select random genre from games rented
-        pipeline_genres = [
-            {'$match': {'_id': {'$in': rented_game_ids}}},
-            {'$unwind': '$genres'},
-            {'$group': {'_id': '$genres', 'count': {'$sum': 1}}}
-        ]
-        genres_data = list(self.game_collection.aggregate(pipeline_genres))
-        genres = [g['_id'] for g in genres_data]
-        weights = [g['count'] for g in genres_data]
+        genres_data = index.genre_counts(rented_game_ids)
+        if not genres_data:
+            return ["No games rented"]
+        genres = list(genres_data)
+        weights = list(genres_data.values())
         selected_genre = random.choices(genres, weights=weights, k=1)[0]
 
         # select 5 random games
-        pipeline_games = [
-            {'$match': {'genres': selected_genre}},
-            {'$sample': {'size': 5}}
-        ]
-        random_games = list(self.game_collection.aggregate(pipeline_games))
-        game_titles = [game['title'] for game in random_games]
-
-        return game_titles
-
+        return index.sample(selected_genre, 5)
 
     def recommend_games_by_name(self, user: dict) -> list:
         rented_game_ids = user.get("rented_games_ids", [])
@@ -138,64 +663,49 @@ class DBManager:
         if not rented_game_ids:
             return ["No games rented"]
 
-        rented_games = list(self.game_collection.find({"_id": {"$in": rented_game_ids}}))
+        index = self.get_title_index()
+        rented_positions = [index.positions[game_id] for game_id in rented_game_ids if game_id in index.positions]
 
-        if not rented_games:
+        if not rented_positions:
             return ["No games rented"]
 
-        rand_game = random.choice(rented_games)
-        game_title = rand_game["title"]
-
-        all_games = list(self.game_collection.find())
-        all_games_title = [game["title"] for game in all_games if game["_id"] not in rented_game_ids] #TODO -> make sure that all game titles are from the games that are not rented
-
-        vectorizer = TfidfVectorizer()
-        tfidf_mat = vectorizer.fit_transform([game_title] + all_games_title)
-
-        similarities = cosine_similarity(tfidf_mat[0:1], tfidf_mat[1:]).flatten()
+        game_title = index.titles[random.choice(rented_positions)]
 
-        similarities = similarities.argsort()[::-1]
-        recommended_titles = [all_games_title[i] for i in similarities[:5]]
-
-        return recommended_titles
+        # all games that are not rented by the user are candidates
+        return index.most_similar(game_title, k=5, exclude_ids=rented_game_ids)
 
     def find_top_rated_games(self, min_score) -> list:
+        # walks the user_score index from the top and stops at min_score
         return list(
             self.game_collection.find(
                 {'user_score': {'$gte': min_score}},
                 {'title': 1, 'user_score': 1, '_id': 0}
-            )
+            ).sort('user_score', pymongo.DESCENDING)
         )
 
     def decrement_scores(self, platform_name) -> None:
-        self.game_collection.update_many(
+        result = self.game_collection.update_many(
             {'platform': platform_name},
             {'$inc': {'user_score': -1}}
         )
+        if result.modified_count:
+            self.platform_stats.update_one(
+                {'_id': platform_name},
+                {'$inc': {'score_sum': -result.modified_count}}
+            )
 
     def get_average_score_per_platform(self) -> dict:
-        pipeline = [
-            {"$group": {
-                "_id": "$platform",
-                "average_score": {"$avg": "$user_score"}
-            }},
-            {"$project": {
-                "_id": 1,
-                "average_score": {"$round": ["$average_score", 3]}
-            }}
-        ]
-
-        results = self.game_collection.aggregate(pipeline)
-        return {result["_id"]: result["average_score"] for result in results}
-
+        stats = list(self.platform_stats.find())
+        if not stats:
+            self.rebuild_platform_stats()
+            stats = list(self.platform_stats.find())
+        return {
+            stat['_id']: round(stat['score_sum'] / stat['scored_games'], 3) if stat['scored_games'] else None
+            for stat in stats
+        }
 
     def get_genres_distribution(self) -> dict:
-        pipeline_genres = [
-            {'$unwind': '$genres'},
-            {'$group': {'_id': '$genres', 'count': {'$sum': 1}}}
-        ]
-        genres_data = list(self.game_collection.aggregate(pipeline_genres))
-        return {item['_id']: item['count'] for item in genres_data}
+        return self.get_genre_index().distribution()
 
 
 if __name__ == '__main__':
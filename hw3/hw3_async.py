@@ -0,0 +1,355 @@
+import asyncio
+import random
+import time
+
+import pandas as pd
+import pymongo
+import pymongo.errors
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from hw3 import (GenreIndex, TitleIndex, parse_genres, rent_results, return_results, RentalResult, CredentialVerifier,
+                 inserted_games)
+
+
+class AsyncLoginManager:
+
+    def __init__(self, rounds: int = 12, session_ttl: float = 300.0) -> None:
+        # MongoDB connection
+        self.client = AsyncIOMotorClient("mongodb://localhost:27017/")
+        self.db = self.client["hw3"]
+        self.collection = self.db["users"]
+        self.verifier = CredentialVerifier(rounds, session_ttl=session_ttl)
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index('username', unique=True)
+
+    async def register_user(self, username: str, password: str) -> None:
+        if not username or not password:
+            raise ValueError("Username and password are required.")
+
+        if len(username) < 3 or len(password) < 3:
+            raise ValueError("Username and password must be at least 3 characters.")
+
+        # the existence check and the hash don't depend on each other
+        existing, hashed_pass = await asyncio.gather(
+            self.collection.find_one({"username": username}, {"_id": 1}),
+            asyncio.wrap_future(self.verifier.submit_hash(password))
+        )
+        if existing:
+            raise ValueError(f"User already exists: {username}.")
+
+        try:
+            await self.collection.insert_one({"username": username, "password": hashed_pass})
+        except pymongo.errors.DuplicateKeyError:
+            # registered concurrently after the check above, the unique index rejected this one
+            raise ValueError(f"User already exists: {username}.")
+
+    async def login_user(self, username: str, password: str) -> object:
+        user = await self.collection.find_one({"username": username}, {"password": 1})
+        if user is None or not await asyncio.wrap_future(self.verifier.submit_verify(password, user["password"])):
+            raise ValueError("Invalid username or password")
+
+        if self.verifier.needs_rehash(user["password"]):
+            hashed_pass = await asyncio.wrap_future(self.verifier.submit_hash(password))
+            await self.collection.update_one({"_id": user["_id"]}, {"$set": {"password": hashed_pass}})
+
+        print(f"Logged in successfully as: {username}")
+        return self.verifier.create_session(username)
+
+    def validate_session(self, token: str):
+        return self.verifier.validate_session(token)
+
+    def logout_user(self, token: str) -> None:
+        self.verifier.end_session(token)
+
+
+class AsyncDBManager:
+
+    def __init__(self, title_backend=None) -> None:
+        # MongoDB connection
+        self.client = AsyncIOMotorClient("mongodb://localhost:27017/")
+        self.db = self.client["hw3"]
+        self.user_collection = self.db["users"]
+        self.game_collection = self.db["games"]
+        # in-memory indexes, built on first use
+        self.title_backend = title_backend
+        self.title_index = None
+        self.genre_index = None
+        self.platform_stats = self.db["platform_stats"]
+
+    async def ensure_indexes(self) -> None:
+        await asyncio.gather(
+            self.user_collection.create_index('username', unique=True),
+            self.game_collection.create_index('title', unique=True),
+            self.game_collection.create_index('platform'),
+            self.game_collection.create_index('user_score'),
+            self.game_collection.create_index('genres'),
+        )
+
+    async def load_csv(self, csv_file: str = 'NintendoGames.csv', batch_size: int = 1000) -> None:
+        start = time.perf_counter()
+        existing_titles = set(await self.game_collection.distinct('title'))
+        track_stats = not existing_titles or await self.platform_stats.estimated_document_count() > 0
+
+        inserted = 0
+        pending = None
+        for chunk in pd.read_csv(csv_file, chunksize=batch_size):
+            chunk['user_score'] = chunk['user_score'].astype(float)
+            chunk['genres'] = chunk['genres'].map(parse_genres)
+            chunk['is_rented'] = False
+
+            games_to_add = []
+            for game_data in chunk.to_dict('records'):
+                if game_data['title'] in existing_titles:
+                    continue
+                existing_titles.add(game_data['title'])
+                games_to_add.append(game_data)
+
+            # parse the next chunk while this one is being written
+            if pending is not None:
+                inserted += await pending
+            pending = asyncio.create_task(self._insert_games(games_to_add, track_stats)) if games_to_add else None
+        if pending is not None:
+            inserted += await pending
+
+        elapsed = time.perf_counter() - start
+        rate = inserted / elapsed if elapsed > 0 else 0.0
+        print(f"{inserted} games were inserted in {elapsed:.2f}s ({rate:.0f} games/sec)")
+
+        if inserted and not track_stats:
+            await self.rebuild_platform_stats()
+
+        if inserted and self.title_index is not None:
+            await self.rebuild_title_index()
+
+    async def _insert_games(self, games_to_add: list, track_stats: bool) -> int:
+        try:
+            await self.game_collection.insert_many(games_to_add, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            games_to_add = inserted_games(games_to_add, e)
+        if track_stats and games_to_add:
+            await self._add_platform_stats(games_to_add)
+        if self.genre_index is not None:
+            self.genre_index.add(games_to_add)
+        return len(games_to_add)
+
+    async def rebuild_platform_stats(self) -> None:
+        # one document per platform, written back with upserts instead of $merge
+        stats = await self.game_collection.aggregate([
+            {'$group': {
+                '_id': '$platform',
+                'score_sum': {'$sum': '$user_score'},
+                'scored_games': {'$sum': {'$cond': [{'$isNumber': '$user_score'}, 1, 0]}}
+            }}
+        ]).to_list(length=None)
+        if stats:
+            await self.platform_stats.bulk_write([
+                pymongo.ReplaceOne({'_id': stat['_id']}, stat, upsert=True) for stat in stats
+            ], ordered=False)
+
+    async def _add_platform_stats(self, games: list) -> None:
+        totals = {}
+        for game in games:
+            if isinstance(game.get('user_score'), (int, float)):
+                total = totals.setdefault(game['platform'], [0.0, 0])
+                total[0] += game['user_score']
+                total[1] += 1
+        if totals:
+            await self.platform_stats.bulk_write([
+                pymongo.UpdateOne(
+                    {'_id': platform},
+                    {'$inc': {'score_sum': score_sum, 'scored_games': scored_games}},
+                    upsert=True
+                )
+                for platform, (score_sum, scored_games) in totals.items()
+            ], ordered=False)
+
+    async def rebuild_title_index(self) -> None:
+        games = await self.game_collection.find({}, {'title': 1}).to_list(length=None)
+        index = TitleIndex(self.title_backend)
+        # fitting is CPU work, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, index.build, games)
+        self.title_index = index
+
+    async def rebuild_genre_index(self) -> None:
+        index = GenreIndex()
+        index.add(await self.game_collection.find({}, {'title': 1, 'genres': 1}).to_list(length=None))
+        self.genre_index = index
+
+    async def warm_up(self) -> None:
+        # both indexes are independent, load them together
+        await asyncio.gather(self.rebuild_title_index(), self.rebuild_genre_index())
+
+    async def rent_game(self, user: dict, game_title: str) -> RentalResult:
+        game = await self.game_collection.find_one_and_update(
+            {'title': game_title, 'is_rented': {'$ne': True}},
+            {'$set': {'is_rented': True, 'rented_by': user['_id']}},
+            projection={'_id': 1}
+        )
+
+        if not game:
+            if not await self.game_collection.find_one({'title': game_title}, {'_id': 1}):
+                return RentalResult(game_title, 'not_found', None, f"{game_title} not found")
+            return RentalResult(game_title, 'already_rented', None, f"{game_title} is already rented")
+
+        try:
+            await self.user_collection.update_one(
+                {'_id': user['_id']},
+                {'$push': {'rented_games_ids': game['_id']}}
+            )
+        except Exception:
+            await self.game_collection.update_one(
+                {'_id': game['_id']},
+                {'$set': {'is_rented': False}, '$unset': {'rented_by': ''}}
+            )
+            raise
+
+        return RentalResult(game_title, 'rented', game['_id'], f"{game_title} rented successfully")
+
+    async def return_game(self, user: dict, game_title: str) -> RentalResult:
+        game = await self.game_collection.find_one_and_update(
+            {'title': game_title, 'is_rented': True, '_id': {'$in': user.get('rented_games_ids', [])}},
+            {'$set': {'is_rented': False}, '$unset': {'rented_by': ''}},
+            projection={'_id': 1}
+        )
+
+        if not game:
+            if not await self.game_collection.find_one({'title': game_title}, {'_id': 1}):
+                return RentalResult(game_title, 'not_found', None, "failure")
+            return RentalResult(game_title, 'not_rented', None, f"{game_title} was not rented by you")
+
+        await self.user_collection.update_one(
+            {"_id": user["_id"]},
+            {"$pull": {"rented_games_ids": game["_id"]}}
+        )
+        return RentalResult(game_title, 'returned', game['_id'], f"{game_title} returned successfully")
+
+    async def rent_games(self, user: dict, game_titles: list) -> list:
+        game_titles = list(dict.fromkeys(game_titles))
+        games = {game['title']: game for game in await self.game_collection.find(
+            {'title': {'$in': game_titles}}, {'title': 1, 'is_rented': 1}
+        ).to_list(length=None)}
+        free_ids = [game['_id'] for game in games.values() if not game.get('is_rented', False)]
+
+        rented_ids = set()
+        if free_ids:
+            claimed = await self.game_collection.update_many(
+                {'_id': {'$in': free_ids}, 'is_rented': {'$ne': True}},
+                {'$set': {'is_rented': True, 'rented_by': user['_id']}}
+            )
+            if claimed.modified_count == len(free_ids):
+                rented_ids = set(free_ids)
+            else:
+                rented_ids = {game['_id'] for game in await self.game_collection.find(
+                    {'_id': {'$in': free_ids}, 'rented_by': user['_id']}, {'_id': 1}
+                ).to_list(length=None)}
+        if rented_ids:
+            await self.user_collection.update_one(
+                {'_id': user['_id']},
+                {'$push': {'rented_games_ids': {'$each': [i for i in free_ids if i in rented_ids]}}}
+            )
+
+        return rent_results(game_titles, games, rented_ids)
+
+    async def return_games(self, user: dict, game_titles: list) -> list:
+        game_titles = list(dict.fromkeys(game_titles))
+        games = {game['title']: game for game in await self.game_collection.find(
+            {'title': {'$in': game_titles}}, {'title': 1, 'is_rented': 1}
+        ).to_list(length=None)}
+        user_game_ids = set(user.get('rented_games_ids', []))
+        returned_ids = [game['_id'] for game in games.values()
+                        if game.get('is_rented', False) and game['_id'] in user_game_ids]
+
+        if returned_ids:
+            # the two documents are updated independently
+            await asyncio.gather(
+                self.game_collection.update_many(
+                    {'_id': {'$in': returned_ids}, 'is_rented': True},
+                    {'$set': {'is_rented': False}, '$unset': {'rented_by': ''}}
+                ),
+                self.user_collection.update_one(
+                    {'_id': user['_id']},
+                    {'$pull': {'rented_games_ids': {'$in': returned_ids}}}
+                )
+            )
+
+        return return_results(game_titles, games, returned_ids)
+
+    async def recommend_games_by_genre(self, user: dict) -> list:
+        rented_game_ids = user.get('rented_games_ids', [])
+        if not rented_game_ids:
+            return ["No games rented"]
+        if self.genre_index is None:
+            await self.rebuild_genre_index()
+        genres_data = self.genre_index.genre_counts(rented_game_ids)
+        if not genres_data:
+            return ["No games rented"]
+        selected_genre = random.choices(list(genres_data), weights=list(genres_data.values()), k=1)[0]
+        return self.genre_index.sample(selected_genre, 5)
+
+    async def recommend_games_by_name(self, user: dict) -> list:
+        rented_game_ids = user.get("rented_games_ids", [])
+
+        if not rented_game_ids:
+            return ["No games rented"]
+
+        if self.title_index is None:
+            await self.rebuild_title_index()
+        index = self.title_index
+        rented_positions = [index.positions[game_id] for game_id in rented_game_ids if game_id in index.positions]
+
+        if not rented_positions:
+            return ["No games rented"]
+
+        game_title = index.titles[random.choice(rented_positions)]
+        return index.most_similar(game_title, k=5, exclude_ids=rented_game_ids)
+
+    async def find_top_rated_games(self, min_score) -> list:
+        return await self.game_collection.find(
+            {'user_score': {'$gte': min_score}},
+            {'title': 1, 'user_score': 1, '_id': 0}
+        ).sort('user_score', pymongo.DESCENDING).to_list(length=None)
+
+    async def decrement_scores(self, platform_name) -> None:
+        result = await self.game_collection.update_many(
+            {'platform': platform_name},
+            {'$inc': {'user_score': -1}}
+        )
+        if result.modified_count:
+            await self.platform_stats.update_one(
+                {'_id': platform_name},
+                {'$inc': {'score_sum': -result.modified_count}}
+            )
+
+    async def get_average_score_per_platform(self) -> dict:
+        stats = await self.platform_stats.find().to_list(length=None)
+        if not stats:
+            await self.rebuild_platform_stats()
+            stats = await self.platform_stats.find().to_list(length=None)
+        return {
+            stat['_id']: round(stat['score_sum'] / stat['scored_games'], 3) if stat['scored_games'] else None
+            for stat in stats
+        }
+
+    async def get_genres_distribution(self) -> dict:
+        if self.genre_index is None:
+            await self.rebuild_genre_index()
+        return self.genre_index.distribution()
+
+
+if __name__ == '__main__':
+    async def main():
+        db_manager = AsyncDBManager()
+        await db_manager.ensure_indexes()
+        await db_manager.load_csv()
+        await db_manager.warm_up()
+
+        # dashboard queries don't depend on each other
+        avg_scores, genre_distribution = await asyncio.gather(
+            db_manager.get_average_score_per_platform(),
+            db_manager.get_genres_distribution()
+        )
+        print("Average scores per platform:", avg_scores)
+        print("Genre distribution:", genre_distribution)
+
+    asyncio.run(main())